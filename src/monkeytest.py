@@ -10,38 +10,86 @@ and deleted, so the script doesn't waste your drive
 (!) Be sure, that the file you point to is not something
     you need, cause it'll be overwritten during test
 
-Runs on both Python3 and 2, despite that I prefer 3
-Has been tested on 3.5 and 2.7 under ArchLinux
+Needs Python 3.6 or later; --batch, and O_DIRECT reads from several
+jobs, a workload or the async engine, need 3.7
+Has been tested on 3.5 under ArchLinux
 Has been tested on 3.5.2 under Ubuntu Xenial
 Has been tested on 3.6.7 under Ubuntu Bionic
 '''
-from __future__ import division, print_function  # for compatability with py2
+import os
+import sys
+import mmap
+import platform
+import queue
+import threading
+from array import array
+from collections import deque
+from bisect import bisect_left
+from itertools import accumulate, groupby, islice
+from math import ceil, erfc, exp, expm1, frexp, fsum, log, log1p, sqrt
+from random import Random, random, randrange, sample
+import argparse
+import datetime
+import json
+import signal
+import statistics
 try:
-    import Tkinter as tk
-    import ttk
-    import tkFileDialog as filedialog
-    import tkMessageBox as messagebox
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+from time import perf_counter as time, sleep
+
+try:
+    import colorama as col
 except ImportError:
+    class col:
+        '''Stands in for colorama when it isn't installed: no colours.'''
+        class Fore:
+            RED = YELLOW = ''
+
+        class Style:
+            RESET_ALL = ''
+
+# The GUI, plotting and numpy stacks are only imported when a run needs
+# them, so the CLI starts fast and Benchmark works with the standard
+# library alone.
+tk = ttk = filedialog = messagebox = FigureCanvasTkAgg = None
+plt = plticker = Figure = None
+NUMPY = []
+
+
+def load_gui():
+    '''Imports Tk, ttkthemes when installed, and the matplotlib Tk canvas for the GUI.'''
+    global tk, ttk, filedialog, messagebox, FigureCanvasTkAgg, ttkthemes
     import tkinter as tk
     import tkinter.ttk as ttk
     from tkinter import filedialog
     from tkinter import messagebox
+    try:
+        import ttkthemes
+    except ImportError:
+        pass
+    load_plotting()
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 
-try:
-    import ttkthemes
-except:
-    pass
 
-import os
-import sys
-import platform
-from random import shuffle
-import argparse
-import json
-import matplotlib.pyplot as plt
-import matplotlib.ticker as plticker
-import numpy as np
-import colorama as col
+def load_plotting():
+    '''Imports matplotlib for the graphs; raises ImportError when it isn't installed.'''
+    global plt, plticker, Figure
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as plticker
+    from matplotlib.figure import Figure
+
+
+def load_numpy():
+    '''numpy, imported on first use, or None: it only speeds up the statistics of big sample stores.'''
+    if not NUMPY:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        NUMPY.append(numpy)
+    return NUMPY[0]
 
 ASCIIART = r'''Brought to you by coding monkeys.
 Eat bananas, drink coffee & enjoy!
@@ -66,189 +114,2303 @@ Eat bananas, drink coffee & enjoy!
 # text-image is a bit old (1999) so I couldn't find a way to communicate with author
 # if You're reading this and You're an author -- feel free to write me
 
-try:  # if Python >= 3.3 use new high-res counter
-    from time import perf_counter as time
-except ImportError:  # else select highest available resolution counter
-    if sys.platform[:3] == 'win':
-        from time import clock as time
-    else:
-        from time import time
-
 
 def get_args():
     parser = argparse.ArgumentParser(description='Arguments', formatter_class = argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-f', '--file',
                         required=False,
                         action='store',
-                        default='/tmp/monkeytest',
-                        help='The file to read/write to')
+                        nargs='+',
+                        default=['/tmp/monkeytest'],
+                        help='The file to read/write to; several files (e.g. one per drive) are benchmarked '
+                             'at the same time, each in its own process pinned to its own CPUs')
     parser.add_argument('-s', '--size',
                         required=False,
                         action='store',
                         default=128,
+                        type=int,
                         help='Total MB to write')
     parser.add_argument('-w', '--write-block-size',
                         required=False,
                         action='store',
                         default=1024,
-                        help='The block size for writing in bytes')
+                        type=int,
+                        help='The block size for writing in KB')
     parser.add_argument('-r', '--read-block-size',
                         required=False,
                         action='store',
                         default=512,
+                        type=int,
                         help='The block size for reading in bytes')
+    parser.add_argument('-t', '--jobs', '--iodepth',
+                        required=False,
+                        dest='jobs',
+                        default=1,
+                        type=int,
+                        help='Number of worker threads issuing I/O to the file at once (queue depth)')
+    parser.add_argument('-p', '--payload',
+                        required=False,
+                        default='random',
+                        choices=PayloadPool.PATTERNS,
+                        help='Data written to the file: incompressible random bytes, zeros or compressible')
+    parser.add_argument('--compress-percent',
+                        required=False,
+                        default=50,
+                        type=int,
+                        help='Percent of each 4 KiB chunk left as zeros with --payload compressible')
+    parser.add_argument('--pool-size',
+                        required=False,
+                        default=16,
+                        type=int,
+                        help='Size in MB of the pre-generated payload pool writes are sliced from')
+    parser.add_argument('-d', '--direct',
+                        required=False,
+                        action='store_true',
+                        help='Open the file with O_DIRECT, bypassing the page cache')
+    parser.add_argument('--drop-cache',
+                        required=False,
+                        action='store_true',
+                        help='Drop the file from the page cache between the write and read phases')
+    parser.add_argument('--sync',
+                        required=False,
+                        default='block',
+                        choices=Benchmark.SYNC_POLICIES,
+                        help='When written data is flushed: fsync each block, none, every N blocks, every N bytes, '
+                             'once at the end, fdatasync each block or O_DSYNC writes')
+    parser.add_argument('--sync-every',
+                        required=False,
+                        default=64,
+                        type=int,
+                        help='N for --sync blocks (blocks) and --sync bytes (bytes)')
+    parser.add_argument('--histogram',
+                        required=False,
+                        action='store_true',
+                        help='Keep latencies in a constant-memory log-bucketed histogram instead of per-block samples')
+    parser.add_argument('--workload',
+                        required=False,
+                        default='write-read',
+                        choices=Benchmark.WORKLOADS,
+                        help='write-read is a sequential write then a random read; the others run a single '
+                             'sequential, random or mixed (randrw) phase over the file')
+    parser.add_argument('--rwmix-read',
+                        required=False,
+                        default=70,
+                        type=int,
+                        help='Percent of operations that are reads with --workload randrw')
+    parser.add_argument('--distribution',
+                        required=False,
+                        default='uniform',
+                        choices=Benchmark.DISTRIBUTIONS,
+                        help='How random offsets are picked')
+    parser.add_argument('--stride',
+                        required=False,
+                        default=16,
+                        type=int,
+                        help='Blocks between consecutive offsets with --distribution stride')
+    parser.add_argument('--zipf-theta',
+                        required=False,
+                        default=1.2,
+                        type=float,
+                        help='Skew of --distribution zipf, higher is more skewed')
+    parser.add_argument('--runtime',
+                        required=False,
+                        default=0,
+                        type=float,
+                        help='Run the workload for this many seconds instead of until --size MB are transferred '
+                             '(not for write-read)')
+    parser.add_argument('--interval',
+                        required=False,
+                        default=0.1,
+                        type=float,
+                        help='Length in seconds of the throughput time series buckets used for steady state '
+                             'and cliff detection')
+    parser.add_argument('--batch',
+                        required=False,
+                        default=1,
+                        type=int,
+                        help='Blocks moved per preadv/pwritev call in the write-read workload; each block is '
+                             'timed as its share of the call, which cuts the per-block interpreter overhead')
+    parser.add_argument('--repeat',
+                        required=False,
+                        default=1,
+                        type=int,
+                        help='Run this many measured trials on the same test file and report their mean, '
+                             'median and 95%% confidence interval')
+    parser.add_argument('--warmup',
+                        required=False,
+                        default=0,
+                        type=int,
+                        help='Run this many discarded trials before the measured ones')
+    parser.add_argument('--preallocate',
+                        required=False,
+                        default=None,
+                        choices=Benchmark.PREALLOCATE,
+                        help='Lay out the test file before the write phase, timed as its own step: reserve '
+                             'its blocks with posix_fallocate, or only set its length (sparse)')
+    parser.add_argument('-e', '--engine',
+                        required=False,
+                        default='sync',
+                        choices=('sync',) + tuple(ENGINES),
+                        help='I/O engine: sync issues one call at a time per job, async keeps --jobs operations '
+                             'in flight from one event loop, mmap copies blocks in and out of a mapping of the file '
+                             'and syncs with msync; engines this platform can\'t run fall back to sync')
     parser.add_argument('-j', '--json',
                         required=False,
                         action='store',
                         help='Output to json file')
+    parser.add_argument('--store',
+                        required=False,
+                        default=None,
+                        help='Append the run, with its settings and host, kernel, filesystem and device details, '
+                             'to this JSON-lines results file; see "monkeytest.py compare -h"')
+    parser.add_argument('--label',
+                        required=False,
+                        default=None,
+                        help='Free-form label kept with the run in --store, e.g. a firmware or kernel version')
     parser.add_argument('-m', '--mode',
                         required=False,
                         default='cli',
-                        help='Choose either CLI or GUI or TUI')
+                        help='Choose either CLI or GUI or TUI, or DAEMON to keep benchmarking and serve live '
+                             'Prometheus metrics on --listen')
+    parser.add_argument('--rate-mb',
+                        required=False,
+                        default=0,
+                        type=float,
+                        help='Limit I/O to this many MB/s, 0 for no limit; reported speeds then include the '
+                             'waits for the limit')
+    parser.add_argument('--rate-iops',
+                        required=False,
+                        default=0,
+                        type=float,
+                        help='Limit I/O to this many operations per second, 0 for no limit')
+    parser.add_argument('--listen',
+                        required=False,
+                        default='127.0.0.1:9472',
+                        help='Where daemon mode serves /metrics: HOST:PORT, or unix:PATH for a Unix socket')
+    parser.add_argument('--window',
+                        required=False,
+                        default=60,
+                        type=int,
+                        help='Length in seconds of the rolling window of the daemon mode metrics')
     parser.add_argument('-g', '--graph',
                         required=False,
                         default=None,
-                        help='Save a GUI graph into a PNG, Options: Write, Read, Write+Read, Read+Write, Write/Read')
+                        help='Save a GUI graph into a PNG, Options: Write, Read, Write+Read, Read+Write, Write/Read, Throughput')
     parser.add_argument('-gf', '--graph-file',
                         required=False,
                         default='/tmp/',
                         help='Set graph save location')
+    parser.add_argument('--sweep',
+                        required=False,
+                        default=None,
+                        help='Write the file once, then rerun the read phase for every power-of-two block size '
+                             'in a range such as 4K..4M; the chart is saved to --graph-file as sweep.png')
+    parser.add_argument('--sweep-jobs',
+                        required=False,
+                        default='1',
+                        help='Comma separated queue depths (--jobs) to run each --sweep block size at, e.g. 1,4,16')
 
     args = parser.parse_args()
     return args
 
 
-class Benchmark:
+def get_compare_args(argv):
+    parser = argparse.ArgumentParser(prog='monkeytest.py compare',
+                                     description='Flag throughput and tail-latency regressions between two runs in a '
+                                                 '--store results file',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('store',
+                        help='JSON-lines results file written with --store')
+    parser.add_argument('runs',
+                        nargs='*',
+                        default=argparse.SUPPRESS,
+                        help='Baseline and candidate run, by id (or a prefix of it), label or index '
+                             '(-1 is the latest run); the last two runs when none are given')
+    parser.add_argument('-b', '--baseline',
+                        required=False,
+                        default=None,
+                        help='Baseline run, compared with the one run given or else the latest: '
+                             'compare STORE -b BASE [CANDIDATE]')
+    parser.add_argument('--threshold',
+                        required=False,
+                        default=5,
+                        type=float,
+                        help='Smallest change in percent reported as a regression')
+    parser.add_argument('--alpha',
+                        required=False,
+                        default=0.05,
+                        type=float,
+                        help='Significance level of the tests')
+    # intermixed, so the candidate may follow -b BASE; before Python 3.7, give it ahead of -b
+    return getattr(parser, 'parse_intermixed_args', parser.parse_args)(argv)
+
+
+def parse_size(text):
+    '''Parses a byte count such as 512, 4K, 64k or 1M (binary units).'''
+    text = text.strip().upper().rstrip('B')
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    try:
+        if text and text[-1] in units:
+            return int(text[:-1]) * units[text[-1]]
+        return int(text)
+    except ValueError:
+        raise ValueError('Invalid size {!r}'.format(text))
+
+
+def parse_sweep(text):
+    '''
+    Returns the power-of-two block sizes from a range such as 4K..4M,
+    starting at the lower bound and doubling up to the upper bound.
+    '''
+    low, sep, high = text.partition('..')
+    if not sep:
+        raise ValueError('A sweep looks like 4K..4M, not {!r}'.format(text))
+    low, high = parse_size(low), parse_size(high)
+    if low <= 0 or high < low:
+        raise ValueError('Invalid sweep range {!r}'.format(text))
+    sizes = []
+    while low <= high:
+        sizes.append(low)
+        low *= 2
+    return sizes
+
+
+T_975 = (12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+         2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+         2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042)  # Student's t, 97.5%, by df
+
+
+def percentile(ordered, p):
+    '''The p-th percentile of the sorted sequence ordered, interpolated linearly like numpy's default.'''
+    rank = (len(ordered) - 1) * p / 100
+    low = int(rank)
+    if low + 1 >= len(ordered):
+        return float(ordered[-1])
+    return ordered[low] + (ordered[low + 1] - ordered[low]) * (rank - low)
+
+
+def confidence_summary(values):
+    '''
+    Mean, median, sample stddev and the 95% confidence interval of the
+    mean (Student's t) of values; the interval needs two or more values.
+    '''
+    mean = statistics.mean(values)
+    summary = {'Mean': mean, 'Median': statistics.median(values), 'Stddev': 0.0,
+               'CI95 low': None, 'CI95 high': None}
+    if len(values) > 1:
+        summary['Stddev'] = statistics.stdev(values)
+        t = T_975[len(values) - 2] if len(values) - 1 <= len(T_975) else 1.96
+        margin = t * summary['Stddev'] / sqrt(len(values))
+        summary['CI95 low'], summary['CI95 high'] = mean - margin, mean + margin
+    return summary
+
+
+def format_size(size):
+    '''The inverse of parse_size, for labels: 4096 -> 4K.'''
+    for unit, factor in (('G', 1024 ** 3), ('M', 1024 ** 2), ('K', 1024)):
+        if size >= factor and size % factor == 0:
+            return '{}{}'.format(size // factor, unit)
+    return str(size)
+
+
+def mb_per_sec(size, seconds):
+    '''MB/s for size bytes moved in seconds, 0 when nothing was timed.'''
+    return size / (1024 * 1024 * seconds) if seconds else 0
+
+
+def block_device(path):
+    '''
+    The sysfs directory of the block device (disk or partition) holding
+    path, or None when there is none, as for tmpfs or on Windows.
+    '''
+    try:
+        dev = os.stat(os.path.dirname(os.path.abspath(path))).st_dev
+        sys_dir = os.path.realpath('/sys/dev/block/{}:{}'.format(os.major(dev), os.minor(dev)))
+    except (OSError, AttributeError):
+        return None
+    return sys_dir if os.path.isdir(sys_dir) else None
+
+
+def logical_block_size(path):
+    '''
+    Returns the logical sector size of the device holding path, read
+    from sysfs, or 4096 when it can't be found (always a safe alignment).
+    '''
+    sys_dir = block_device(path)
+    if sys_dir is None:
+        return 4096
+    try:
+        # partitions keep their queue settings on the parent disk
+        for directory in (sys_dir, os.path.dirname(sys_dir)):
+            size_file = os.path.join(directory, 'queue', 'logical_block_size')
+            if os.path.isfile(size_file):
+                with open(size_file) as f:
+                    return int(f.read())
+    except (OSError, ValueError):
+        pass
+    return 4096
+
+
+def read_proc_io():
+    '''This process's /proc/self/io counters as a dict, or None off Linux.'''
+    try:
+        with open('/proc/self/io') as f:
+            return {key: int(value) for key, value in (line.split(':') for line in f if ':' in line)}
+    except (OSError, ValueError):
+        return None
+
+
+def read_diskstats(device):
+    '''
+    The /proc/diskstats counters of device (a name such as sda or
+    nvme0n1p2) as a list of ints, starting at reads completed, or None.
+    '''
+    if device is None:
+        return None
+    try:
+        with open('/proc/diskstats') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 14 and fields[2] == device:
+                    return [int(field) for field in fields[3:14]]
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def usage_snapshot(device):
+    '''What usage_delta needs: the clock, getrusage and the /proc counters.'''
+    return {'time': time(), 'rusage': resource.getrusage(resource.RUSAGE_SELF) if resource is not None else None,
+            'io': read_proc_io(), 'disk': read_diskstats(device)}
+
+
+def usage_delta(before, after, device):
+    '''
+    Resource use between two usage_snapshot()s: CPU time and context
+    switches of the whole process (all threads), what it moved through
+    the kernel, and what the device did in the meantime. The device
+    counters are device-wide, so other I/O to the same disk shows up too.
+    Sources missing on this platform are left out or None.
+    '''
+    elapsed = after['time'] - before['time']
+    usage = {'Elapsed (sec)': round(elapsed, 4)}
+    if before['rusage'] is not None:
+        b, a = before['rusage'], after['rusage']
+        cpu = (a.ru_utime - b.ru_utime) + (a.ru_stime - b.ru_stime)
+        usage.update({'User CPU (sec)': round(a.ru_utime - b.ru_utime, 4),
+                      'System CPU (sec)': round(a.ru_stime - b.ru_stime, 4),
+                      'CPU (% of wall time)': round(100 * cpu / elapsed, 1) if elapsed else 0,
+                      'Voluntary context switches': a.ru_nvcsw - b.ru_nvcsw,
+                      'Involuntary context switches': a.ru_nivcsw - b.ru_nivcsw,
+                      'Blocks in': a.ru_inblock - b.ru_inblock,
+                      'Blocks out': a.ru_oublock - b.ru_oublock})
+    usage['Process I/O'] = None
+    if before['io'] is not None and after['io'] is not None:
+        b, a = before['io'], after['io']
+        usage['Process I/O'] = {name: a.get(key, 0) - b.get(key, 0) for name, key in (
+            ('Read syscalls', 'syscr'), ('Write syscalls', 'syscw'), ('Read bytes', 'read_bytes'),
+            ('Write bytes', 'write_bytes'), ('Cancelled write bytes', 'cancelled_write_bytes'))}
+    usage['Device'] = None
+    if before['disk'] is not None and after['disk'] is not None:
+        d = [a - b for a, b in zip(after['disk'], before['disk'])]
+        ops = d[0] + d[4]
+        usage['Device'] = {'Name': device, 'Reads': d[0], 'Reads merged': d[1], 'Read bytes': 512 * d[2],
+                           'Read time (ms)': d[3], 'Writes': d[4], 'Writes merged': d[5],
+                           'Write bytes': 512 * d[6], 'Write time (ms)': d[7],
+                           'Await (ms)': round((d[3] + d[7]) / ops, 3) if ops else 0,
+                           'Busy (%)': round(min(100, d[9] / (10 * elapsed)), 1) if elapsed else 0,
+                           'Average queue depth': round(d[10] / (1000 * elapsed), 2) if elapsed else 0}
+    return usage
+
+
+class PayloadPool:
+    '''
+    A fixed pool of write data generated once before the test starts, so
+    the timed loop hands out memoryview slices of it instead of calling
+    os.urandom for every block. The pool is an anonymous mmap, so it
+    and every align-multiple slice of it are usable with O_DIRECT.
+    '''
+    PATTERNS = ('random', 'zeros', 'compressible')
+    CHUNK = 4096
+
+    def __init__(self, block_size, pattern='random', compress_percent=50, pool_mb=16, align=512):
+        if pattern not in self.PATTERNS:
+            raise ValueError('Unknown payload pattern {!r}'.format(pattern))
+        if pattern == 'compressible' and not 0 <= compress_percent <= 100:
+            raise ValueError('compress_percent must be between 0 and 100')
+        size = max(int(pool_mb * 1024 * 1024), 2 * block_size)
+        size += -size % self.CHUNK
+        self.align = align
+        self.buffer = mmap.mmap(-1, size)  # page-aligned, zero-filled
+        if pattern == 'random':
+            self.buffer[:] = os.urandom(size)
+        elif pattern == 'compressible':
+            random_part = self.CHUNK * (100 - compress_percent) // 100
+            for offset in range(0, size, self.CHUNK):
+                self.buffer[offset:offset + random_part] = os.urandom(random_part)
+        self.view = memoryview(self.buffer)
+
+    def cursor(self, block_size, start=0):
+        '''
+        Yields block_size slices of the pool forever, starting at start.
+        Each time the pool wraps around the start moves on by self.align
+        bytes, so consecutive passes don't repeat the same aligned blocks.
+        '''
+        limit = len(self.buffer) - block_size
+        shift = 0
+        pos = start % (limit + 1)
+        pos -= pos % self.align
+        while True:
+            if pos > limit:
+                shift += self.align
+                if shift > limit:  # back to the start, so the shift stays aligned
+                    shift = 0
+                pos = shift
+            yield self.view[pos:pos + block_size]
+            pos += block_size
+
+
+class SampleStore:
+    '''
+    Per-block times in sec, kept in an array('d') preallocated from the
+    block count (8 bytes a sample). The timed loops write
+    store.values[i] = t directly and set store.count when they finish.
+    store.stamps[i] holds the perf_counter time block i completed at.
+    '''
+
+    def __init__(self, size):
+        self.values = array('d', bytes(8 * size))
+        self.stamps = array('d', bytes(8 * size))
+        self.count = 0
 
-    def __init__(self, file,write_mb, write_block_kb, read_block_b):
+    @classmethod
+    def merge(cls, stores):
+        merged = cls(0)
+        for store in stores:
+            merged.values.extend(islice(store.values, store.count))
+            merged.stamps.extend(islice(store.stamps, store.count))
+        merged.count = len(merged.values)
+        return merged
+
+    def capacity(self):
+        return len(self.values)
+
+    def grow(self):
+        '''Doubles the preallocated space and returns the new capacity.'''
+        extra = bytes(8 * max(1024, len(self.values)))
+        self.values.extend(array('d', extra))
+        self.stamps.extend(array('d', extra))
+        return len(self.values)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return islice(self.values, self.count)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.values[:self.count][i]
+        if not -self.count <= i < self.count:
+            raise IndexError('sample index out of range')
+        return self.values[i % self.count]
+
+    def total(self):
+        return sum(self)
+
+    def min(self):
+        return min(self)
+
+    def max(self):
+        return max(self)
+
+    def array(self, stamps=False):
+        '''
+        Zero-copy numpy view of the samples (or of the completion times),
+        None when numpy isn't installed; the statistics below then fall
+        back to plain Python.
+        '''
+        np = load_numpy()
+        if np is None:
+            return None
+        return np.frombuffer(self.stamps if stamps else self.values, dtype=np.float64, count=self.count)
+
+    def window(self):
+        '''Returns (start of the first block, end of the last) in perf_counter sec, or None.'''
+        if not self.count:
+            return None
+        values, ends = self.array(), self.array(stamps=True)
+        if values is not None:
+            return float((ends - values).min()), float(ends.max())
+        return min(end - t for t, end in zip(self, islice(self.stamps, self.count))), max(islice(self.stamps, self.count))
+
+    def time_series(self, block_size, interval):
+        '''
+        Returns lists of MB/s and IOPS, one entry per interval of seconds
+        since the first block started. The last, partial interval is
+        scaled by its real length.
+        '''
+        if not self.count:
+            return [], []
+        begin, end = self.window()
+        ends = self.array(stamps=True)
+        if ends is not None:
+            np = load_numpy()
+            ops = np.bincount(((ends - begin) // interval).astype(np.int64)).tolist()
+        else:
+            ops = [0] * (int((end - begin) // interval) + 1)
+            for stamp in islice(self.stamps, self.count):
+                ops[int((stamp - begin) // interval)] += 1
+        last = max(end - begin - interval * (len(ops) - 1), interval / 1000)
+        iops = [n / interval for n in ops[:-1]] + [ops[-1] / last]
+        return [n * block_size / (1024 * 1024) for n in iops], iops
+
+    def mean(self):
+        return fsum(self) / self.count
+
+    def stddev(self):
+        values = self.array()
+        if values is not None:
+            return float(values.std())
+        mean = self.mean()
+        return sqrt(fsum((t - mean) ** 2 for t in self) / self.count)
+
+    def percentiles(self, ps):
+        values = self.array()
+        if values is not None:
+            return [float(v) for v in load_numpy().percentile(values, ps)]
+        ordered = sorted(self)
+        return [percentile(ordered, p) for p in ps]
+
+    def log_histogram(self):
+        '''
+        Returns (upper bound in sec, count) for every non-empty
+        power-of-two latency range.
+        '''
+        # zero times (coarse clocks) are counted in the lowest range
+        floor = 2.0 ** LatencyHistogram.MIN_EXP
+        values = self.array()
+        if values is not None:
+            np = load_numpy()
+            _, exps = np.frexp(np.maximum(values, floor))
+            low = int(exps.min())
+            return [(2.0 ** (low + i), int(n)) for i, n in enumerate(np.bincount(exps - low)) if n]
+        counts = {}
+        for t in self:
+            power = frexp(max(t, floor))[1]
+            counts[power] = counts.get(power, 0) + 1
+        return [(2.0 ** power, counts[power]) for power in sorted(counts)]
+
+
+class Discard:
+    '''Write-only sink standing in for arrays a store does not keep.'''
+
+    def __setitem__(self, i, value):
+        pass
+
+
+class LatencyHistogram:
+    '''
+    Constant-memory replacement for SampleStore (--histogram), in the
+    style of HDR histograms: each power-of-two range of seconds is split
+    into SUB_BUCKETS linear buckets, so any recorded time is known to
+    within 1/SUB_BUCKETS of its value. It accepts the same
+    store.values[i] = t writes, ignoring i, and drops completion
+    times, so no throughput time series is kept.
+    '''
+    SUB_BUCKETS = 64
+    MIN_EXP = -30  # ~1 ns
+    MAX_EXP = 12  # ~68 min
+
+    def __init__(self, size=0):
+        self.counts = array('L', [0]) * ((self.MAX_EXP - self.MIN_EXP) * self.SUB_BUCKETS)
+        self.values = self
+        self.stamps = Discard()
+        self.count = 0
+        self.recorded = 0
+        self.sum = 0.0
+        self.sumsq = 0.0
+        self.low = float('inf')
+        self.high = 0.0
+
+    @classmethod
+    def merge(cls, histograms):
+        merged = cls()
+        for histogram in histograms:
+            for i, n in enumerate(histogram.counts):
+                merged.counts[i] += n
+            merged.recorded += histogram.recorded
+            merged.sum += histogram.sum
+            merged.sumsq += histogram.sumsq
+            merged.low = min(merged.low, histogram.low)
+            merged.high = max(merged.high, histogram.high)
+        merged.count = merged.recorded
+        return merged
+
+    def __setitem__(self, i, t):
+        mantissa, exp = frexp(t)  # t = mantissa * 2 ** exp, 0.5 <= mantissa < 1
+        if exp <= self.MIN_EXP or t <= 0:
+            bucket = 0
+        elif exp > self.MAX_EXP:
+            bucket = len(self.counts) - 1
+        else:
+            bucket = (exp - self.MIN_EXP - 1) * self.SUB_BUCKETS + int((mantissa - 0.5) * 2 * self.SUB_BUCKETS)
+        self.counts[bucket] += 1
+        self.recorded += 1
+        self.sum += t
+        self.sumsq += t * t
+        if t < self.low:
+            self.low = t
+        if t > self.high:
+            self.high = t
+
+    def capacity(self):
+        return float('inf')
+
+    def window(self):
+        return None
+
+    def time_series(self, block_size, interval):
+        return [], []
+
+    def bucket_value(self, bucket):
+        '''Returns the midpoint in sec of the given bucket.'''
+        exp, sub = divmod(bucket, self.SUB_BUCKETS)
+        return (0.5 + (sub + 0.5) / (2 * self.SUB_BUCKETS)) * 2.0 ** (exp + self.MIN_EXP + 1)
+
+    def __len__(self):
+        return self.recorded
+
+    def total(self):
+        return self.sum
+
+    def min(self):
+        return self.low
+
+    def max(self):
+        return self.high
+
+    def mean(self):
+        return self.sum / self.recorded
+
+    def stddev(self):
+        return max(0.0, self.sumsq / self.recorded - self.mean() ** 2) ** 0.5
+
+    def percentiles(self, ps):
+        cumulative = list(accumulate(self.counts))
+        ranks = (max(ceil(p / 100 * self.recorded), 1) for p in ps)
+        return [self.bucket_value(bisect_left(cumulative, rank)) for rank in ranks]
+
+    def log_histogram(self):
+        '''
+        Returns (upper bound in sec, count) for every non-empty
+        power-of-two latency range.
+        '''
+        counts = (sum(self.counts[i:i + self.SUB_BUCKETS]) for i in range(0, len(self.counts), self.SUB_BUCKETS))
+        return [(2.0 ** (i + self.MIN_EXP + 1), n) for i, n in enumerate(counts) if n]
+
+
+class ZipfSampler:
+    '''
+    Draws ranks 1..n with probability proportional to 1 / rank ** theta
+    in constant memory, using Hormann's rejection-inversion method.
+    '''
+
+    def __init__(self, n, theta):
+        if theta <= 0:
+            raise ValueError('zipf theta must be greater than 0')
+        self.n = n
+        self.theta = theta
+        self.h_integral_x1 = self.h_integral(1.5) - 1
+        self.h_integral_n = self.h_integral(n + 0.5)
+        self.s = 2 - self.h_integral_inverse(self.h_integral(2.5) - self.h(2))
+
+    @staticmethod
+    def helper1(x):
+        return log1p(x) / x if abs(x) > 1e-8 else 1 - x * (0.5 - x * (1 / 3 - 0.25 * x))
+
+    @staticmethod
+    def helper2(x):
+        return expm1(x) / x if abs(x) > 1e-8 else 1 + x / 2 * (1 + x / 3 * (1 + x / 4))
+
+    def h(self, x):
+        return exp(-self.theta * log(x))
+
+    def h_integral(self, x):
+        log_x = log(x)
+        return self.helper2((1 - self.theta) * log_x) * log_x
+
+    def h_integral_inverse(self, x):
+        t = max(-1, x * (1 - self.theta))
+        return exp(self.helper1(t) * x)
+
+    def sample(self):
+        while True:
+            u = self.h_integral_n + random() * (self.h_integral_x1 - self.h_integral_n)
+            x = self.h_integral_inverse(u)
+            k = min(max(int(x + 0.5), 1), self.n)
+            if k - x <= self.s or u >= self.h_integral(k + 0.5) - self.h(k):
+                return k
+
+
+class BlockPermutation:
+    '''
+    Visits block indices 0..count-1 once each in random order, in
+    constant memory: a full-cycle linear congruential generator over the
+    next power of two (Hull-Dobell: odd increment, multiplier 5 mod 8)
+    that skips the values past count, so even a multi-terabyte file needs
+    no offsets list. share(n, parts) is every parts-th step of the same
+    cycle starting at step n, so parts workers split it without overlap.
+    '''
+
+    def __init__(self, count, seed=None):
+        self.count = count
+        self.period = 1 << max(0, count - 1).bit_length()
+        self.mask = self.period - 1
+        rng = Random(seed)
+        self.multiplier = (8 * rng.randrange(self.period) + 5) & self.mask
+        self.increment = (2 * rng.randrange(self.period) + 1) & self.mask
+        self.start = rng.randrange(self.period)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return self.share(0, 1)
+
+    def capacity(self, n, parts):
+        '''How many blocks share(n, parts) can yield at most.'''
+        return len(range(n, self.period, parts))
+
+    def share(self, n, parts):
+        mask, count = self.mask, self.count
+        a, c = 1, 0  # parts steps of the generator folded into one
+        for _ in range(parts):
+            a, c = (a * self.multiplier) & mask, (c * self.multiplier + self.increment) & mask
+        x = self.start
+        for _ in range(n):
+            x = (x * self.multiplier + self.increment) & mask
+        for _ in range(n, self.period, parts):
+            if x < count:
+                yield x
+            x = (x * a + c) & mask
+
+
+class RateLimiter:
+    '''
+    Token buckets on bytes and operations per second, shared by all the
+    workers of a run. A caller takes its tokens before timing an
+    operation and sleeps off any debt, so throttling never shows up in
+    the latencies. Up to burst sec of unused budget can be saved up.
+    '''
+
+    def __init__(self, mb_per_sec=0, iops=0, burst=0.1):
+        self.byte_rate = mb_per_sec * 1024 * 1024
+        self.op_rate = iops
+        self.burst = burst
+        self.bytes = self.ops = 0.0
+        self.last = time()
+        self.lock = threading.Lock()
+
+    def reserve(self, size, ops=1):
+        '''Takes size bytes and ops operations and returns how long to wait in sec.'''
+        with self.lock:
+            now = time()
+            elapsed, self.last = now - self.last, now
+            wait = 0
+            if self.byte_rate:
+                self.bytes = min(self.bytes + elapsed * self.byte_rate, self.burst * self.byte_rate) - size
+                wait = max(wait, -self.bytes / self.byte_rate)
+            if self.op_rate:
+                self.ops = min(self.ops + elapsed * self.op_rate, self.burst * self.op_rate) - ops
+                wait = max(wait, -self.ops / self.op_rate)
+            return wait
+
+    def take(self, size, ops=1):
+        wait = self.reserve(size, ops)
+        if wait > 0:
+            sleep(wait)
+
+
+ENGINES = {}
+
+
+def register_engine(engine):
+    '''
+    Makes an I/O engine class selectable with --engine under its name.
+    Engines provide available(), open_mode() and run(); see AsyncEngine. Extra
+    backends, e.g. io_uring bindings, can be plugged in the same way.
+    '''
+    ENGINES[engine.name] = engine
+    return engine
+
+
+@register_engine
+class AsyncEngine:
+    '''
+    Keeps iodepth (--jobs) operations in flight from a single asyncio
+    event loop. Every positional os.pread/os.pwrite is handed to a pool of
+    iodepth threads so the loop never blocks, and its latency is measured
+    from submission to completion.
+    '''
+    name = 'async'
+
+    @staticmethod
+    def available():
+        return hasattr(os, 'pread') and hasattr(os, 'pwrite')
+
+    def __init__(self, benchmark):
+        self.benchmark = benchmark
+        self.iodepth = benchmark.jobs
+
+    @staticmethod
+    def open_mode(mode):
+        '''The Benchmark.open mode the engine needs for a phase opened as mode.'''
+        return mode
+
+    def run(self, f, ops, reads, writes, read_block, write_block, moved, flushed, runtime=0):
+        '''
+        Performs every (is_read, offset) from ops on descriptor f, storing
+        latencies in reads and writes and adding up bytes in moved[0] and
+        flush time in flushed[0]. Stops early after runtime sec if given.
+        '''
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        loop = asyncio.new_event_loop()
+        executor = ThreadPoolExecutor(self.iodepth)
+        try:
+            loop.run_until_complete(self.drive(loop, executor, f, iter(ops), reads, writes,
+                                               read_block, write_block, moved, flushed, runtime))
+        finally:
+            executor.shutdown()
+            loop.close()
+
+    async def drive(self, loop, executor, f, ops, reads, writes, read_block, write_block, moved, flushed, runtime):
+        import asyncio
+        benchmark = self.benchmark
+        blocks = benchmark.pool.cursor(write_block) if writes is not None else None
+        sync = os.fdatasync if benchmark.sync == 'fdatasync' else os.fsync
+        every = benchmark.sync_interval(write_block)
+        capacity = {id(reads): reads.capacity() if reads is not None else 0,
+                    id(writes): writes.capacity() if writes is not None else 0}
+        deadline = time() + runtime if runtime else None
+        stop = benchmark.stopped
+        limit = benchmark.limiter
+        written = [0]  # writes completed, numbered as they finish so one slot flushes per boundary
+        flushing = [0, 0.0]  # flushes in flight and when the first of them started
+
+        def record(store, start, end):
+            if store.count == capacity[id(store)]:
+                capacity[id(store)] = store.grow()
+            store.values[store.count] = end - start
+            store.stamps[store.count] = end
+            store.count += 1
+
+        async def slot():
+            buff = mmap.mmap(-1, read_block)  # aligned, so it also works with O_DIRECT
+            for is_read, offset in ops:  # every slot pulls the next op from the shared stream
+                if stop[0] or deadline and time() >= deadline:
+                    break
+                if is_read:
+                    if limit is not None:
+                        await asyncio.sleep(limit.reserve(read_block))
+                    start = time()
+                    if benchmark.direct:
+                        got = await loop.run_in_executor(executor, os.preadv, f, [buff], offset)
+                    else:
+                        got = len(await loop.run_in_executor(executor, os.pread, f, read_block, offset))
+                    end = time()
+                    if not got: break  # if EOF reached
+                    record(reads, start, end)
+                    moved[0] += read_block
+                else:
+                    data = next(blocks)
+                    if limit is not None:
+                        await asyncio.sleep(limit.reserve(write_block))
+                    start = time()
+                    await loop.run_in_executor(executor, os.pwrite, f, data, offset)
+                    written[0] += 1
+                    if every and written[0] % every == 0:
+                        if not flushing[0]:
+                            flushing[1] = time()
+                        flushing[0] += 1
+                        await loop.run_in_executor(executor, sync, f)  # force write to disk
+                        flushing[0] -= 1
+                        if not flushing[0]:  # overlapping flushes count once
+                            flushed[0] += time() - flushing[1]
+                    record(writes, start, time())
+                    moved[0] += write_block
+
+        await asyncio.gather(*(slot() for _ in range(self.iodepth)))
+
+
+@register_engine
+class MmapEngine:
+    '''
+    Maps the test file and does every read and write as a slice copy out
+    of and into the mapping, so the I/O is driven by page faults and
+    writeback instead of syscalls. The mapping is advised sequential or
+    random to match the phase, and msync (mmap.flush) is the sync step.
+    Runs on a single thread; --jobs does not apply.
+    '''
+    name = 'mmap'
+
+    @staticmethod
+    def available():
+        return hasattr(mmap, 'mmap')
+
+    def __init__(self, benchmark):
+        self.benchmark = benchmark
+
+    @staticmethod
+    def open_mode(mode):
+        return 'read' if mode == 'read' else 'rw'  # a writable shared mapping needs a readable descriptor
+
+    def advice(self, reads, writes):
+        '''MADV_SEQUENTIAL for the write phase of write-read and the seq-* workloads, MADV_RANDOM otherwise.'''
+        workload = self.benchmark.workload
+        if workload.startswith('seq') or workload == 'write-read' and reads is None:
+            return getattr(mmap, 'MADV_SEQUENTIAL', None)
+        return getattr(mmap, 'MADV_RANDOM', None)
+
+    def run(self, f, ops, reads, writes, read_block, write_block, moved, flushed, runtime=0):
+        '''
+        Performs every (is_read, offset) from ops through a mapping of
+        descriptor f, with the same arguments as AsyncEngine.run. A file
+        being written is first extended to its full size, as the mapping
+        can't grow.
+        '''
+        benchmark = self.benchmark
+        size = os.fstat(f).st_size
+        if writes is not None and size < benchmark.write_mb * 1024 * 1024:
+            size = benchmark.write_mb * 1024 * 1024
+            os.ftruncate(f, size)
+        if not size:
+            return
+        mapping = mmap.mmap(f, size, access=mmap.ACCESS_READ if writes is None else mmap.ACCESS_WRITE)
+        advice = self.advice(reads, writes)
+        if advice is not None and hasattr(mapping, 'madvise'):
+            mapping.madvise(advice)
+        view = memoryview(mapping)
+        try:
+            self.copy(mapping, view, ops, reads, writes, read_block, write_block, moved, flushed, runtime)
+        finally:
+            view.release()
+            mapping.close()
+
+    def copy(self, mapping, view, ops, reads, writes, read_block, write_block, moved, flushed, runtime):
+        benchmark = self.benchmark
+        blocks = benchmark.pool.cursor(write_block) if writes is not None else None
+        every = benchmark.sync_interval(write_block)
+        buff = bytearray(read_block)
+        size = len(mapping)
+        read_capacity = reads.capacity() if reads is not None else 0
+        write_capacity = writes.capacity() if writes is not None else 0
+        dirty_low, dirty_high = size, 0  # range written since the last msync
+        deadline = time() + runtime if runtime else None
+        stop = benchmark.stopped
+        limit = benchmark.limiter
+        for is_read, offset in ops:
+            if stop[0] or deadline and time() >= deadline:
+                break
+            if offset >= size: break  # if EOF reached
+            if is_read:
+                got = min(read_block, size - offset)
+                if limit is not None:
+                    limit.take(got)
+                start = time()
+                buff[:got] = view[offset:offset + got]
+                end = time()
+                if reads.count == read_capacity:
+                    read_capacity = reads.grow()
+                reads.values[reads.count] = end - start
+                reads.stamps[reads.count] = end
+                reads.count += 1
+                moved[0] += read_block
+            else:
+                data = next(blocks)
+                got = min(write_block, size - offset)
+                if limit is not None:
+                    limit.take(got)
+                start = time()
+                view[offset:offset + got] = data[:got]
+                end = time()
+                dirty_low, dirty_high = min(dirty_low, offset), max(dirty_high, offset + got)
+                if every and (writes.count + 1) % every == 0:
+                    low = dirty_low - dirty_low % mmap.ALLOCATIONGRANULARITY  # msync wants aligned offsets
+                    mapping.flush(low, dirty_high - low)  # force write to disk
+                    flush = time() - end
+                    flushed[0] += flush
+                    end += flush
+                    dirty_low, dirty_high = size, 0
+                if writes.count == write_capacity:
+                    write_capacity = writes.grow()
+                writes.values[writes.count] = end - start
+                writes.stamps[writes.count] = end
+                writes.count += 1
+                moved[0] += write_block
+
+
+class BenchmarkCancelled(Exception):
+    '''Raised by Benchmark.run when Benchmark.cancel stopped the run.'''
+
+
+class Benchmark:
+    SYNC_POLICIES = ('block', 'none', 'blocks', 'bytes', 'end', 'fdatasync', 'dsync')
+    PERCENTILES = (50, 90, 99, 99.9, 99.99)
+    WORKLOADS = ('write-read', 'seq-write', 'seq-read', 'rand-write', 'rand-read', 'randrw')
+    DISTRIBUTIONS = ('uniform', 'stride', 'zipf')
+    PREALLOCATE = ('fallocate', 'sparse')
+    PROGRESS_INTERVAL = 0.1
+    STEADY_WINDOW = 10  # intervals
+    STEADY_RANGE = 0.2  # max - min within 20% of the window mean
+    STEADY_SLOPE = 0.1  # best-fit line moves less than 10% of the mean over the window
+    CLIFF_WINDOW = 5  # intervals averaged on each side of a cliff
+    CLIFF_DROP = 0.5  # a cliff halves the throughput
+    CALIBRATE_BLOCKS = 20000
+    SAMPLE_KEEP = 2000  # latencies per phase kept in a --store record
+    OVERHEAD_WARN = 0.25  # share of the mean latency spent on the tool's own bookkeeping
+
+    def __init__(self, file,write_mb, write_block_kb, read_block_b, jobs=1,
+                 payload='random', compress_percent=50, pool_mb=16,
+                 direct=False, drop_cache=False, sync='block', sync_every=64, histogram=False,
+                 workload='write-read', rwmix_read=70, distribution='uniform', stride=16, zipf_theta=1.2,
+                 runtime=0, engine='sync', interval=0.1, batch=1, repeat=1, warmup=0,
+                 rate_mb=0, rate_iops=0, preallocate=None):
         self.file = file
         self.write_mb = write_mb
         self.write_block_kb = write_block_kb
         self.read_block_b = read_block_b
+        self.read_block = read_block_b  # block size of the last read phase, which a sweep varies
+        self.jobs = max(1, int(jobs))
+        self.payload = payload
+        self.compress_percent = compress_percent
+        self.pool_mb = pool_mb
+        self.direct = direct
+        self.drop_cache = drop_cache
+        self.align = 512
+        self.sync = sync
+        self.sync_every = sync_every
+        self.histogram = histogram
+        self.workload = workload
+        self.rwmix_read = rwmix_read
+        self.distribution = distribution
+        self.stride = stride
+        self.zipf_theta = zipf_theta
+        self.runtime = runtime
+        self.engine = engine
+        self.engine_fallback = None
+        self.interval = interval
+        self.batch = batch
+        self.repeat = repeat
+        self.warmup = warmup
+        self.overhead = 0
+        self.rate_mb = rate_mb
+        self.rate_iops = rate_iops
+        self.limiter = RateLimiter(rate_mb, rate_iops) if rate_mb or rate_iops else None
+        self.preallocate = preallocate
+        self.preallocate_time = 0
+        self.stopped = [False]  # a list, so the timed loops can check it cheaply
+        self.status = {'phase': None, 'percent': 0, 'ops': 0, 'bytes': 0, 'elapsed': 0}
+        device = block_device(file)
+        self.device = os.path.basename(device) if device is not None else None
+        self.usage = {}
+        self.ready = None  # called once, with all setup done, just before the first timed phase
+        if direct:
+            self.check_direct()
+        self.check_sync()
+        self.check_payload()
+        self.check_workload()
+        self.check_engine()
+
+    def check_engine(self):
+        '''
+        Falls back to the sync engine when the requested one can't run
+        here, remembering it in engine_fallback. Raises ValueError for an
+        unknown engine and for settings the engine can't honour.
+        '''
+        if self.engine != 'sync' and self.engine not in ENGINES:
+            raise ValueError('Unknown engine {!r}'.format(self.engine))
+        if self.engine != 'sync' and not ENGINES[self.engine].available():
+            self.engine_fallback, self.engine = self.engine, 'sync'
+        if self.engine == 'mmap' and self.direct:
+            raise ValueError('--direct does not apply to the mmap engine')
+        if self.engine == 'mmap' and self.sync == 'dsync':
+            raise ValueError('O_DSYNC does not apply to mapped writes, use --sync block or blocks for msync')
+        if self.engine == 'mmap' and self.jobs > 1:
+            raise ValueError('The mmap engine runs on a single thread, --jobs does not apply')
+
+    def check_workload(self):
+        '''
+        Raises ValueError for workload settings that can't be run.
+        '''
+        if self.workload not in self.WORKLOADS:
+            raise ValueError('Unknown workload {!r}'.format(self.workload))
+        if self.distribution not in self.DISTRIBUTIONS:
+            raise ValueError('Unknown distribution {!r}'.format(self.distribution))
+        if not 0 <= self.rwmix_read <= 100:
+            raise ValueError('--rwmix-read must be between 0 and 100')
+        if self.stride <= 0:
+            raise ValueError('--stride must be greater than 0')
+        if self.zipf_theta <= 0:
+            raise ValueError('--zipf-theta must be greater than 0')
+        if self.runtime < 0:
+            raise ValueError('--runtime must not be negative')
+        if self.runtime and self.workload == 'write-read':
+            raise ValueError('--runtime applies to the other workloads; write-read writes and reads --size MB')
+        if self.interval <= 0:
+            raise ValueError('--interval must be greater than 0')
+        if self.batch <= 0:
+            raise ValueError('--batch must be greater than 0')
+        if self.repeat <= 0:
+            raise ValueError('--repeat must be greater than 0')
+        if self.warmup < 0:
+            raise ValueError('--warmup must not be negative')
+        if self.rate_mb < 0 or self.rate_iops < 0:
+            raise ValueError('--rate-mb and --rate-iops must not be negative')
+        if self.preallocate is not None:
+            if self.preallocate not in self.PREALLOCATE:
+                raise ValueError('Unknown preallocation {!r}'.format(self.preallocate))
+            if self.workload not in ('write-read', 'seq-write'):
+                raise ValueError('--preallocate applies to the write-read and seq-write workloads')
+            if self.preallocate == 'fallocate' and not hasattr(os, 'posix_fallocate'):
+                raise ValueError('posix_fallocate is not supported on this platform')
+        if self.batch > 1:
+            if self.workload != 'write-read' or self.engine != 'sync':
+                raise ValueError('--batch applies to the write-read workload with the sync engine')
+            if not hasattr(os, 'preadv') or not hasattr(os, 'pwritev'):
+                raise ValueError('--batch needs preadv/pwritev, which this platform lacks')
+            try:
+                iov_max = os.sysconf('SC_IOV_MAX')
+            except (AttributeError, ValueError, OSError):
+                iov_max = 1024  # IOV_MAX on Linux, the BSDs and macOS
+            if iov_max > 0 and self.batch > iov_max:
+                raise ValueError('--batch must be at most {}, the most buffers one preadv/pwritev call takes here'.format(
+                    iov_max))
+
+    def check_payload(self):
+        '''
+        Raises ValueError for an unknown payload pattern, or a compressible
+        one whose --compress-percent is out of range.
+        '''
+        if self.payload not in PayloadPool.PATTERNS:
+            raise ValueError('Unknown payload pattern {!r}'.format(self.payload))
+        if self.payload == 'compressible' and not 0 <= self.compress_percent <= 100:
+            raise ValueError('--compress-percent must be between 0 and 100')
+
+    def check_sync(self):
+        '''
+        Raises ValueError for an unknown sync policy or one this platform
+        can't provide.
+        '''
+        if self.sync not in self.SYNC_POLICIES:
+            raise ValueError('Unknown sync policy {!r}'.format(self.sync))
+        if self.sync == 'fdatasync' and not hasattr(os, 'fdatasync'):
+            raise ValueError('fdatasync is not supported on this platform')
+        if self.sync == 'dsync' and not hasattr(os, 'O_DSYNC'):
+            raise ValueError('O_DSYNC is not supported on this platform')
+        if self.sync in ('blocks', 'bytes') and self.sync_every <= 0:
+            raise ValueError('--sync-every must be greater than 0')
+
+    def sync_interval(self, block_size):
+        '''
+        Returns after how many blocks the write loop flushes, 0 for never.
+        '''
+        if self.sync in ('block', 'fdatasync'):
+            return 1
+        if self.sync == 'blocks':
+            return self.sync_every
+        if self.sync == 'bytes':
+            return max(1, self.sync_every // block_size)
+        return 0
+
+    def check_direct(self):
+        '''
+        Raises ValueError when O_DIRECT can't be used with the current
+        block sizes, which have to be multiples of the logical sector size.
+        '''
+        if not hasattr(os, 'O_DIRECT'):
+            raise ValueError('O_DIRECT is not supported on this platform')
+        if not hasattr(os, 'preadv') and (self.jobs > 1 or self.workload != 'write-read' or self.engine == 'async'):
+            raise ValueError('O_DIRECT reads from several jobs, a workload or the async engine need os.preadv '
+                             '(Python 3.7)')
+        self.align = logical_block_size(self.file)
+        for name, size in (('Write block', 1024 * self.write_block_kb), ('Read block', self.read_block_b)):
+            if size % self.align:
+                raise ValueError('{} size {} B is not a multiple of the {} B logical sector size'.format(
+                    name, size, self.align))
+
+    def new_store(self, size):
+        '''Returns an empty latency store for size blocks.'''
+        return LatencyHistogram() if self.histogram else SampleStore(size)
+
+    def open(self, mode):
+        flags = {'write': os.O_CREAT | os.O_WRONLY, 'read': os.O_RDONLY, 'rw': os.O_CREAT | os.O_RDWR}[mode]
+        if self.direct:
+            flags |= os.O_DIRECT
+        if self.sync == 'dsync' and mode != 'read':
+            flags |= os.O_DSYNC
+        return os.open(self.file, flags, 0o777)  # low-level I/O
+
+    def evict_cache(self):
+        '''
+        Asks the kernel to drop the test file from the page cache, so the
+        read phase has to go to the device.
+        '''
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        f = os.open(self.file, os.O_RDONLY)
+        try:
+            os.fsync(f)
+            os.posix_fadvise(f, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(f)
+
+    def cancel(self):
+        '''
+        Asks a run going on in another thread to stop; its timed loops
+        stop at the next block and run raises BenchmarkCancelled.
+        '''
+        self.stopped[0] = True
+
+    def calibrate(self, blocks=None):
+        '''
+        Times the bookkeeping the timed loops do around every call (two
+        clock reads, storing the sample and the stamp, the stop check)
+        with no I/O in between, and returns it in sec per block. When it
+        comes close to the mean latency the interpreter, not the device,
+        is what gets measured.
+        '''
+        store = SampleStore(blocks or self.CALIBRATE_BLOCKS)
+        samples, stamps = store.values, store.stamps
+        stop = self.stopped
+        batch = self.batch
+        done = 0
+        began = time()
+        while done + batch <= len(samples):
+            if stop[0]: break
+            start = time()
+            end = time()
+            share = (end - start) / batch
+            for i in range(done, done + batch):
+                samples[i] = share
+                stamps[i] = end
+            done += batch
+        return (time() - began) / max(done, 1)
 
     def run(self, show_progress=True, update_pb=False):
+        '''
+        Runs self.warmup discarded trials and then self.repeat measured
+        ones over the same test file. The phases of the last trial stay
+        on self as usual; with more than one trial, self.trials keeps a
+        summary row of each measured one.
+        '''
+        self.overhead = self.calibrate()
+        if self.repeat == 1 and not self.warmup:
+            self.run_once(show_progress, update_pb)
+            return
+        self.trials = []
+        for trial in range(self.warmup + self.repeat):
+            if show_progress:
+                print('\r{} {}/{}'.format(*(('Warmup', trial + 1, self.warmup) if trial < self.warmup else
+                                            ('Trial', trial - self.warmup + 1, self.repeat))), end=' ')
+            self.run_once(show_progress, update_pb)
+            if trial >= self.warmup:
+                self.trials.append(self.trial_row())
+
+    def trial_row(self):
+        '''Throughput, IOPS and latency percentiles of the phases just run.'''
+        row = {}
+        for phase, took, elapsed, moved in (('Write', self.write_results, self.write_time, self.write_bytes),
+                                            ('Read', self.read_results, self.read_time, self.read_bytes)):
+            if not len(took):
+                continue
+            stats = self.latency_stats(took, elapsed)
+            row[phase + ' speed in MB/s'] = mb_per_sec(moved, elapsed)
+            row[phase + ' IOPS'] = stats['IOPS']
+            for p in ('p50', 'p99', 'p99.9'):
+                row['{} {} (ms)'.format(phase, p)] = stats['Percentiles (ms)'][p]
+        return row
+
+    def trials_summary(self):
+        '''confidence_summary of every trial_row metric across the measured trials.'''
+        return {key: confidence_summary([row[key] for row in self.trials]) for key in self.trials[0]}
+
+    def trials_result(self):
+        result = '\n\n{} trials{}\n{:<24} {:>12} {:>12} {:>12} {:>25}\n'.format(
+            len(self.trials), ' after {} warmup'.format(self.warmup) if self.warmup else '',
+            '', 'Mean', 'Median', 'Stddev', '95% CI')
+        for key, summary in self.trials_summary().items():
+            ci = ('[{:.3f}, {:.3f}]'.format(summary['CI95 low'], summary['CI95 high'])
+                  if summary['CI95 low'] is not None else 'n/a')
+            result += '{:<24} {:>12.3f} {:>12.3f} {:>12.3f} {:>25}\n'.format(
+                key, summary['Mean'], summary['Median'], summary['Stddev'], ci)
+        return result
+
+    def run_once(self, show_progress=True, update_pb=False):
+        self.usage = {}
+        if self.preallocate is not None:
+            self.preallocate_file(self.write_mb * 1024 * 1024)
+        if self.workload != 'write-read':
+            self.workload_test(show_progress, update_pb)
+            self.write_results, self.read_results = self.write_took, self.read_took
+            return
         wr_blocks = int(self.write_mb * 1024 / self.write_block_kb)
         rd_blocks = int(self.write_mb * 1024 * 1024 / self.read_block_b)
         self.write_results = self.write_test( 1024 * self.write_block_kb, wr_blocks, show_progress, update_pb)
+        if self.drop_cache:
+            self.evict_cache()
         self.read_results = self.read_test(self.read_block_b, rd_blocks, show_progress, update_pb)
 
+    def sweep_test(self, block_sizes, jobs_list=(1,), show_progress=True):
+        '''
+        Writes the test file once with the write phase, then reruns the
+        read phase for every block size at every queue depth in
+        jobs_list. One row per run ends up in self.sweep_results, and the
+        read phase of the last run stays in self.read_results.
+        '''
+        file_size = self.write_mb * 1024 * 1024
+        for block_size in block_sizes:
+            if block_size > file_size:
+                raise ValueError('Sweep block size {} B is larger than the {} MB file'.format(block_size, self.write_mb))
+            if self.direct and block_size % self.align:
+                raise ValueError('Sweep block size {} B is not a multiple of the {} B logical sector size'.format(
+                    block_size, self.align))
+        self.overhead = self.calibrate()
+        self.usage = {}
+        if self.preallocate is not None:
+            self.preallocate_file(file_size)
+        wr_blocks = int(self.write_mb * 1024 / self.write_block_kb)
+        self.write_results = self.write_test(1024 * self.write_block_kb, wr_blocks, show_progress)
+        jobs = self.jobs
+        self.sweep_results = []
+        try:
+            for block_size in block_sizes:
+                for self.jobs in jobs_list:
+                    if self.drop_cache:
+                        self.evict_cache()
+                    self.read_results = self.read_test(block_size, file_size // block_size, show_progress)
+                    stats = self.latency_stats(self.read_results, self.read_time)
+                    self.sweep_results.append({
+                        'Block size (B)': block_size, 'Jobs': self.jobs,
+                        'Read speed in MB/s': round(mb_per_sec(self.read_bytes, self.read_time), 2),
+                        'IOPS': stats['IOPS'], 'Mean (ms)': stats['Mean (ms)'],
+                        'p99 (ms)': stats['Percentiles (ms)']['p99']})
+        finally:
+            self.jobs = jobs
+
+    def sweep_result(self):
+        result = '\n\n{:>12} {:>5} {:>12} {:>12} {:>12} {:>12}\n'.format(
+            'Block size', 'Jobs', 'MB/s', 'IOPS', 'Mean (ms)', 'p99 (ms)')
+        for row in self.sweep_results:
+            result += '{:>12} {:>5} {:>12.2f} {:>12.0f} {:>12.4f} {:>12.4f}\n'.format(
+                format_size(row['Block size (B)']), row['Jobs'], row['Read speed in MB/s'],
+                row['IOPS'], row['Mean (ms)'], row['p99 (ms)'])
+        return result
+
     def write_test(self, block_size, blocks_count, show_progress=True, update_pb=False):
         '''
         Tests write speed by writing random blocks, at total quantity
         of blocks_count, each at size of block_size bytes to disk.
-        Function returns a list of write times in sec of each block.
+        Function returns a SampleStore of write times in sec of each block;
+        a block that triggers a flush includes the flush in its time, and
+        the total time spent flushing is kept in self.write_flush_time.
         '''
-        f = os.open(self.file, os.O_CREAT | os.O_WRONLY, 0o777)  # low-level I/O
-
-        self.write_took = []
-        self.wperc_took = []
-        prev_perc = 0
-        for i in range(blocks_count):
-            if show_progress:
-                # dirty trick to actually print progress on each iteration
-                sys.stdout.write('\rWriting: {:.2f} %'.format(
-                    (i + 1) * 100 / blocks_count))
-                sys.stdout.flush()
-            if update_pb is not False:
-                update_pb["value"] = ((i + 1) * 100 / blocks_count)
-                update_pb.update()
-                prev_perc = ((i + 1) * 100 / blocks_count)
-
-            buff = os.urandom(block_size)
-            start = time()
-            os.write(f, buff)
-            os.fsync(f)  # force write to disk
-            t = time() - start
-            self.write_took.append(t)
-            self.wperc_took.append(((i + 1) * 100 / blocks_count))
-
-        os.close(f)
-        if update_pb is not False:
-            update_pb["value"] = 100
+        self.pool = PayloadPool(block_size, self.payload, self.compress_percent, self.pool_mb, self.align)
+        if self.engine != 'sync':
+            ops = ((False, offset) for offset in range(0, blocks_count * block_size, block_size))
+            _, self.write_took, wall = self.engine_test('write', ops, block_size, block_size, 0, blocks_count,
+                                                        blocks_count * block_size, show_progress, update_pb)
+            self.write_blocks, self.write_worker_took, self.write_time = blocks_count, [self.write_took], wall
+            self.write_bytes = len(self.write_took) * block_size
+            return self.write_took
+        if self.batch > 1:
+            return self.batched_test('write', block_size, blocks_count, show_progress, update_pb)
+        if self.jobs > 1:
+            return self.parallel_test('write', block_size, blocks_count, show_progress, update_pb)
+
+        self.write_blocks = blocks_count
+        self.write_took = self.new_store(blocks_count)
+        samples, stamps = self.write_took.values, self.write_took.stamps
+        blocks = self.pool.cursor(block_size)
+        sync = os.fdatasync if self.sync == 'fdatasync' else os.fsync
+        every = self.sync_interval(block_size)
+        self.write_flush_time = 0
+        done = [0]  # read by the progress reporter in run_workers
+        flushed = [0]
+        stop = self.stopped
+        limit = self.limiter
+
+        def worker(n, barrier):
+            f = self.open('write')
+            try:
+                barrier.wait()
+                for i in range(blocks_count):
+                    if stop[0]: break
+                    if limit is not None:
+                        limit.take(block_size)
+                    buff = next(blocks)
+                    start = time()
+                    os.write(f, buff)
+                    end = time()
+                    if every and (i + 1) % every == 0:
+                        sync(f)  # force write to disk
+                        flush = time() - end
+                        flushed[0] += flush
+                        end += flush
+                    samples[i] = end - start
+                    stamps[i] = end
+                    done[0] = i + 1
+                self.write_took.count = done[0]
+                done.append(self.final_flush(f))
+            finally:
+                os.close(f)
+
+        wall = self.run_workers(worker, 1, 'Writing', lambda: done[0] * 100 / blocks_count, show_progress,
+                                update_pb, lambda: (done[0], done[0] * block_size))
+        self.write_flush_time = flushed[0] + done[1]
+        self.write_worker_took = [self.write_took]
+        # throttled runs report wall throughput, waits included, as the threaded phases do
+        self.write_time = wall if limit is not None else self.write_took.total() + done[1]
+        self.write_bytes = len(self.write_took) * block_size
         return self.write_took
 
+    def final_flush(self, f):
+        '''
+        Flushes whatever the sync policy left unflushed at the end of the
+        write loop and returns the time it took.
+        '''
+        if self.sync not in ('blocks', 'bytes', 'end'):
+            return 0
+        start = time()
+        os.fsync(f)
+        return time() - start
+
     def read_test(self, block_size, blocks_count, show_progress=True, update_pb=False):
         '''
         Performs read speed test by reading random offset blocks from
         file, at maximum of blocks_count, each at size of block_size
-        bytes until the End Of File reached.
-        Returns a list of read times in sec of each block.
-        '''
-        f = os.open(self.file, os.O_RDONLY, 0o777)  # low-level I/O
-        # generate random read positions
-        offsets = list(range(0, blocks_count * block_size, block_size))
-        shuffle(offsets)
-
-        self.read_took = []
-        self.rperc_took = []
-        prev_perc = 0
-        for i, offset in enumerate(offsets, 1):
-            if show_progress and i % int(self.write_block_kb * 1024 / self.read_block_b) == 0:
-                # read is faster than write, so try to equalize print period
-                sys.stdout.write('\rReading: {:.2f} %'.format(
-                    (i + 1) * 100 / blocks_count))
-                sys.stdout.flush()
-            if update_pb is not False and ((i + 1) * 100 / blocks_count)-1 > prev_perc:
-                update_pb["value"] = ((i + 1) * 100 / blocks_count)
-                update_pb.update()
-                prev_perc = ((i + 1) * 100 / blocks_count)
+        bytes until the End Of File reached. The offsets come from a
+        BlockPermutation, so they take no memory however large the file.
+        Returns a SampleStore of read times in sec of each block.
+        '''
+        self.read_block = block_size
+        if self.engine != 'sync':
+            ops = ((True, block * block_size) for block in BlockPermutation(blocks_count))
+            self.read_took, _, wall = self.engine_test('read', ops,
+                                                       block_size, block_size, blocks_count, 0,
+                                                       blocks_count * block_size, show_progress, update_pb)
+            self.read_blocks, self.read_worker_took, self.read_time = blocks_count, [self.read_took], wall
+            self.read_bytes = len(self.read_took) * block_size
+            return self.read_took
+        if self.batch > 1:
+            return self.batched_test('read', block_size, blocks_count, show_progress, update_pb)
+        if self.jobs > 1:
+            return self.parallel_test('read', block_size, blocks_count, show_progress, update_pb)
+        direct = self.direct
+        if direct:
+            buff = mmap.mmap(-1, block_size)  # O_DIRECT needs an aligned buffer
+        # random read positions, generated as the loop goes
+        offsets = (block * block_size for block in BlockPermutation(blocks_count))
+
+        self.read_blocks = blocks_count
+        self.read_took = self.new_store(blocks_count)
+        samples, stamps = self.read_took.values, self.read_took.stamps
+        done = [0]  # read by the progress reporter in run_workers
+        stop = self.stopped
+        limit = self.limiter
+
+        def worker(n, barrier):
+            f = self.open('read')
+            try:
+                barrier.wait()
+                for i, offset in enumerate(offsets):
+                    if stop[0]: break
+                    if limit is not None:
+                        limit.take(block_size)
+                    start = time()
+                    os.lseek(f, offset, os.SEEK_SET)  # set position
+                    if direct:
+                        got = os.readv(f, [buff])
+                    else:
+                        got = len(os.read(f, block_size))  # read from position
+                    end = time()
+                    if not got: break  # if EOF reached
+                    samples[i] = end - start
+                    stamps[i] = end
+                    done[0] = i + 1
+                self.read_took.count = done[0]
+            finally:
+                os.close(f)
+
+        wall = self.run_workers(worker, 1, 'Reading', lambda: done[0] * 100 / blocks_count, show_progress,
+                                update_pb, lambda: (done[0], done[0] * block_size))
+        self.read_worker_took = [self.read_took]
+        self.read_time = wall if limit is not None else self.read_took.total()
+        self.read_bytes = len(self.read_took) * block_size
+        return self.read_took
 
-            start = time()
-            os.lseek(f, offset, os.SEEK_SET)  # set position
-            buff = os.read(f, block_size)  # read from position
-            t = time() - start
-            if not buff: break  # if EOF reached
-            self.read_took.append(t)
-            self.rperc_took.append(((i + 1) * 100 / blocks_count))
-
-        os.close(f)
+    def call_ready(self):
+        '''Calls the ready hook, if any, once: before whichever timed step comes first.'''
+        if self.ready is not None:
+            ready, self.ready = self.ready, None
+            ready()
+
+    def run_workers(self, worker, count, label, progress, show_progress=True, update_pb=False, counters=None):
+        '''
+        Starts count threads running worker(n, barrier). Each opens its
+        file and waits on the barrier, so they all start together. While
+        they run, this thread reports progress() percent every
+        PROGRESS_INTERVAL sec, so the timed loops only do I/O, take
+        timestamps and bump a counter. The figures are also published in
+        self.status (plus ops and bytes from counters()) for callers on
+        other threads, such as the GUI. What the phase cost in CPU, context
+        switches and device I/O goes to self.usage under 'Write', 'Read'
+        or the workload name. Returns the
+        wall-clock time from the release of the barrier until the last
+        worker finished, and re-raises the first error a worker hit.
+        '''
+        errors = []
+        started = []
+
+        def release():  # runs once all have arrived, before any is let go
+            started.append(usage_snapshot(self.device))
+            started.append(time())
+
+        barrier = threading.Barrier(count + 1, action=release)
+
+        def target(n):
+            try:
+                worker(n, barrier)
+            except Exception as e:  # handed over to the main thread below
+                errors.append(e)
+                barrier.abort()
+
+        self.call_ready()
+        threads = [threading.Thread(target=target, args=(n,)) for n in range(count)]
+        for thread in threads:
+            thread.start()
+        try:
+            barrier.wait()
+        except threading.BrokenBarrierError:
+            pass
+        before, start = started if started else (usage_snapshot(self.device), time())
+        jobs = ' ({} jobs)'.format(count) if count > 1 else ''
+        self.status.update(phase=label, percent=0, ops=0, bytes=0, elapsed=0)
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(self.PROGRESS_INTERVAL)
+                perc = min(progress(), 100)
+                ops, moved = counters() if counters is not None else (0, 0)
+                self.status.update(percent=perc, ops=ops, bytes=moved, elapsed=time() - start)
+                if show_progress:
+                    sys.stdout.write('\r{}: {:.2f} %{}'.format(label, perc, jobs))
+                    sys.stdout.flush()
+                if update_pb is not False:
+                    update_pb["value"] = perc
+                    update_pb.update()
+        wall = time() - start
+        phase = {'Writing': 'Write', 'Reading': 'Read'}.get(label, label)
+        self.usage[phase] = usage_delta(before, usage_snapshot(self.device), self.device)
+        if show_progress:
+            sys.stdout.write('\r{}: {:.2f} %{}'.format(label, min(progress(), 100), jobs))
+            sys.stdout.flush()
+        if errors:
+            raise next((e for e in errors if not isinstance(e, threading.BrokenBarrierError)), errors[0])
+        if self.stopped[0]:
+            raise BenchmarkCancelled('{} was cancelled'.format(label))
         if update_pb is not False:
             update_pb["value"] = 100
-        return self.read_took
+        return wall
+
+    def job_chunks(self, mode, units):
+        '''
+        Splits the indices 0..units-1 over self.jobs workers: writers get
+        contiguous ranges, readers an equal share of a BlockPermutation.
+        Returns the chunks and the most indices each one can hold.
+        '''
+        if mode == 'read':
+            order = BlockPermutation(units)
+            return ([order.share(n, self.jobs) for n in range(self.jobs)],
+                    [order.capacity(n, self.jobs) for n in range(self.jobs)])
+        per_job = -(-units // self.jobs)
+        chunks = [range(units)[n * per_job:(n + 1) * per_job] for n in range(self.jobs)]
+        return chunks, [len(chunk) for chunk in chunks]
+
+    def run_jobs(self, mode, worker, took, done, flushed, block_size, blocks_count, show_progress, update_pb):
+        '''
+        Runs worker on one thread per store in took, then merges the
+        stores and keeps the figures of the phase on self, as the
+        threaded phases share them. done and flushed hold each worker's
+        block count and flush time. Returns the merged store.
+        '''
+        wall = self.run_workers(worker, len(took), 'Writing' if mode == 'write' else 'Reading',
+                                lambda: sum(done) * 100 / blocks_count, show_progress, update_pb,
+                                lambda: (sum(done), sum(done) * block_size))
+
+        merged = type(took[0]).merge(took)
+        if mode == 'write':
+            self.write_took, self.write_blocks = merged, blocks_count
+            self.write_worker_took, self.write_time = took, wall
+            self.write_flush_time = sum(flushed)
+            self.write_bytes = len(merged) * block_size
+        else:
+            self.read_took, self.read_blocks = merged, blocks_count
+            self.read_worker_took, self.read_time = took, wall
+            self.read_bytes = len(merged) * block_size
+        return merged
+
+    def parallel_test(self, mode, block_size, blocks_count, show_progress=True, update_pb=False):
+        '''
+        Spreads blocks_count blocks of block_size bytes over self.jobs
+        threads, each with its own descriptor on the same file, so the
+        device sees a queue depth of self.jobs. Writers get contiguous
+        offset ranges, readers an equal share of a BlockPermutation.
+        Returns the merged store of times in sec of each block; per-worker
+        stores and the wall-clock time of the phase are kept on self.
+        '''
+        chunks, sizes = self.job_chunks(mode, blocks_count)
+        took = [self.new_store(size) for size in sizes]
+        flushed = [0] * len(chunks)
+        done = [0] * len(chunks)  # one slot per worker, so no lock is needed
+        stop = self.stopped
+        limit = self.limiter
+
+        def worker(n, barrier):
+            f = self.open(mode)
+            if mode == 'write':
+                blocks = self.pool.cursor(block_size, n * len(self.pool.buffer) // len(chunks))
+                sync = os.fdatasync if self.sync == 'fdatasync' else os.fsync
+                every = self.sync_interval(block_size)
+            elif self.direct:
+                buff = mmap.mmap(-1, block_size)  # O_DIRECT needs an aligned buffer
+            samples, stamps = took[n].values, took[n].stamps
+            try:
+                barrier.wait()
+                for block in chunks[n]:
+                    if stop[0]: break
+                    offset = block * block_size
+                    if limit is not None:
+                        limit.take(block_size)
+                    if mode == 'write':
+                        buff = next(blocks)
+                        start = time()
+                        os.pwrite(f, buff, offset)
+                        end = time()
+                        if every and (done[n] + 1) % every == 0:
+                            sync(f)  # force write to disk
+                            flush = time() - end
+                            flushed[n] += flush
+                            end += flush
+                    elif self.direct:
+                        start = time()
+                        got = os.preadv(f, [buff], offset)
+                        end = time()
+                        if not got: break  # if EOF reached
+                    else:
+                        start = time()
+                        got = len(os.pread(f, block_size, offset))
+                        end = time()
+                        if not got: break  # if EOF reached
+                    samples[done[n]] = end - start
+                    stamps[done[n]] = end
+                    done[n] += 1
+                took[n].count = done[n]
+                if mode == 'write':
+                    flushed[n] += self.final_flush(f)
+            finally:
+                os.close(f)
+
+        return self.run_jobs(mode, worker, took, done, flushed, block_size, blocks_count, show_progress, update_pb)
+
+    def batched_test(self, mode, block_size, blocks_count, show_progress=True, update_pb=False):
+        '''
+        parallel_test with --batch blocks per call: every pwritev/preadv
+        moves up to self.batch contiguous blocks at once, and each block
+        is stored as an equal share of the call's time, completing when
+        the call did. Reads visit the batches in BlockPermutation order,
+        so they are random at batch granularity.
+        '''
+        batch = self.batch
+        chunks, sizes = self.job_chunks(mode, -(-blocks_count // batch))
+        took = [self.new_store(size * batch) for size in sizes]
+        flushed = [0] * len(chunks)
+        done = [0] * len(chunks)  # one slot per worker, so no lock is needed
+        stop = self.stopped
+        limit = self.limiter
+
+        def worker(n, barrier):
+            f = self.open(mode)
+            if mode == 'write':
+                blocks = self.pool.cursor(block_size, n * len(self.pool.buffer) // len(chunks))
+                sync = os.fdatasync if self.sync == 'fdatasync' else os.fsync
+                every = self.sync_interval(block_size)
+            else:
+                buffs = [mmap.mmap(-1, block_size) for _ in range(batch)]  # aligned, so O_DIRECT works too
+            samples, stamps = took[n].values, took[n].stamps
+            try:
+                barrier.wait()
+                for index in chunks[n]:
+                    if stop[0]: break
+                    first = index * batch  # first block of the batch
+                    count = min(batch, blocks_count - first)
+                    if limit is not None:
+                        limit.take(count * block_size, count)
+                    if mode == 'write':
+                        data = [next(blocks) for _ in range(count)]
+                        start = time()
+                        os.pwritev(f, data, first * block_size)
+                        end = time()
+                        if every and (done[n] + count) // every > done[n] // every:
+                            sync(f)  # force write to disk
+                            flush = time() - end
+                            flushed[n] += flush
+                            end += flush
+                    else:
+                        start = time()
+                        got = os.preadv(f, buffs[:count], first * block_size)
+                        end = time()
+                        if not got: break  # if EOF reached
+                        count = -(-got // block_size)
+                    share = (end - start) / count
+                    for i in range(done[n], done[n] + count):
+                        samples[i] = share
+                        stamps[i] = end
+                    done[n] += count
+                took[n].count = done[n]
+                if mode == 'write':
+                    flushed[n] += self.final_flush(f)
+            finally:
+                os.close(f)
+
+        return self.run_jobs(mode, worker, took, done, flushed, block_size, blocks_count, show_progress, update_pb)
+
+    def engine_test(self, mode, ops, read_block, write_block, expected_reads, expected_writes, total,
+                    show_progress=True, update_pb=False):
+        '''
+        Runs the (is_read, offset) stream ops through self.engine on a
+        file opened for mode, with the event loop on a worker thread so
+        progress keeps being reported. total is the number of bytes
+        expected, for progress. Returns the read store, the write store
+        and the wall-clock time of the phase.
+        '''
+        reads = self.new_store(expected_reads) if mode != 'write' else None
+        writes = self.new_store(expected_writes) if mode != 'read' else None
+        moved, flushed = [0], [0]
+        engine = ENGINES[self.engine](self)
+
+        def worker(n, barrier):
+            f = self.open(engine.open_mode(mode))
+            try:
+                barrier.wait()
+                engine.run(f, ops, reads, writes, read_block, write_block, moved, flushed, self.runtime)
+                if writes is not None and len(writes):
+                    flushed[0] += self.final_flush(f)
+            finally:
+                os.close(f)
+
+        if self.runtime:
+            started = time()
+            progress = lambda: (time() - started) * 100 / self.runtime
+        else:
+            progress = lambda: moved[0] * 100 / total
+        label = {'write': 'Writing', 'read': 'Reading'}.get(mode, self.workload)
+        wall = self.run_workers(worker, 1, label, progress, show_progress, update_pb,
+                                lambda: ((reads.count if reads is not None else 0) +
+                                         (writes.count if writes is not None else 0), moved[0]))
+        if writes is not None:
+            self.write_flush_time = flushed[0]
+        return (reads if reads is not None else self.new_store(0),
+                writes if writes is not None else self.new_store(0), wall)
+
+    def workload_ops(self, file_size, read_block, write_block, read_fraction, sequential, budget):
+        '''
+        Yields the (is_read, offset) operations of self.workload until
+        budget bytes have been moved, for engines that take an op stream.
+        '''
+        read_offsets = self.offsets(file_size, read_block, sequential)
+        write_offsets = self.offsets(file_size, write_block, sequential)
+        moved = 0
+        while moved < budget:
+            if random() < read_fraction:
+                moved += read_block
+                yield True, next(read_offsets)
+            else:
+                moved += write_block
+                yield False, next(write_offsets)
+
+    def offsets(self, file_size, block_size, sequential, start=0):
+        '''
+        Yields block_size aligned offsets into the first file_size bytes
+        forever: in order from block start when sequential, otherwise
+        picked by self.distribution. Zipf ranks map directly to blocks, so
+        the hottest blocks sit at the start of the file.
+        '''
+        blocks = max(1, file_size // block_size)
+        block = start % blocks
+        if sequential:
+            while True:
+                yield block * block_size
+                block = (block + 1) % blocks
+        elif self.distribution == 'stride':
+            first = block % min(self.stride, blocks)
+            while True:
+                yield block * block_size
+                block += self.stride
+                if block >= blocks:  # next lane, so every block gets visited
+                    first = (first + 1) % min(self.stride, blocks)
+                    block = first
+        elif self.distribution == 'zipf':
+            sampler = ZipfSampler(blocks, self.zipf_theta)
+            while True:
+                yield (sampler.sample() - 1) * block_size
+        else:
+            while True:
+                yield randrange(blocks) * block_size
+
+    def preallocate_file(self, size):
+        '''
+        Lays out the test file as self.preallocate asks, timed on its own
+        so filesystem allocation stays out of the write phase: fallocate
+        reserves size bytes with posix_fallocate and fsyncs the metadata,
+        sparse only sets the length and leaves holes for the writes to
+        fill. The file is emptied first (untimed), so every trial
+        allocates afresh. The time goes to self.preallocate_time.
+        '''
+        f = os.open(self.file, os.O_CREAT | os.O_WRONLY, 0o777)
+        try:
+            os.ftruncate(f, 0)
+            os.fsync(f)
+            self.call_ready()
+            before = usage_snapshot(self.device)
+            start = time()
+            if self.preallocate == 'fallocate':
+                os.posix_fallocate(f, 0, size)
+                os.fsync(f)
+            else:
+                os.ftruncate(f, size)
+            self.preallocate_time = time() - start
+            self.usage['Preallocate'] = usage_delta(before, usage_snapshot(self.device), self.device)
+        finally:
+            os.close(f)
+
+    def prepare_file(self, size):
+        '''
+        Lays out size bytes of the test file (untimed) so there is data to
+        read and random writes overwrite allocated blocks.
+        '''
+        if os.path.isfile(self.file) and os.path.getsize(self.file) >= size:
+            return
+        chunk = max(1024 * 1024 - 1024 * 1024 % self.align, self.align)
+        f = self.open('write')
+        try:
+            blocks = self.pool.cursor(chunk)
+            for offset in range(0, size, chunk):
+                os.pwrite(f, next(blocks)[:min(chunk, size - offset)], offset)
+            os.fsync(f)
+        finally:
+            os.close(f)
+
+    def workload_test(self, show_progress=True, update_pb=False):
+        '''
+        Runs self.workload over a file of self.write_mb MB: sequential or
+        random reads or writes, or random I/O where rwmix_read percent of
+        the operations are reads. Every one of self.jobs threads runs its
+        own stream, until write_mb MB have been moved or, with
+        self.runtime, for that many seconds. Writes use the write block
+        size and reads the read block size.
+        '''
+        file_size = self.write_mb * 1024 * 1024
+        write_block, read_block = 1024 * self.write_block_kb, self.read_block_b
+        self.read_block = read_block
+        self.pool = PayloadPool(write_block, self.payload, self.compress_percent, self.pool_mb, self.align)
+        if self.workload != 'seq-write':
+            self.prepare_file(file_size)
+        read_fraction = {'seq-read': 1, 'rand-read': 1, 'seq-write': 0, 'rand-write': 0,
+                         'randrw': self.rwmix_read / 100}[self.workload]
+        sequential = self.workload.startswith('seq')
+        budget = float('inf') if self.runtime else file_size / self.jobs
+        runtime = self.runtime
+        sync = os.fdatasync if self.sync == 'fdatasync' else os.fsync
+        every = self.sync_interval(write_block)
+
+        if self.engine != 'sync':
+            ops = self.workload_ops(file_size, read_block, write_block, read_fraction, sequential,
+                                    float('inf') if runtime else file_size)
+            expected = 0 if runtime else file_size
+            self.read_took, self.write_took, wall = self.engine_test(
+                'rw' if read_fraction else 'write', ops, read_block, write_block,
+                int(expected * read_fraction) // read_block + 1, int(expected * (1 - read_fraction)) // write_block + 1,
+                file_size, show_progress, update_pb)
+            self.read_worker_took, self.write_worker_took = [self.read_took], [self.write_took]
+            self.read_blocks, self.write_blocks = len(self.read_took), len(self.write_took)
+            self.read_time = self.write_time = wall
+            self.read_bytes = len(self.read_took) * read_block
+            self.write_bytes = len(self.write_took) * write_block
+            return
+
+        expected = (file_size // self.jobs) if not runtime else 0
+        read_took = [self.new_store(int(expected * read_fraction) // read_block + 1) for _ in range(self.jobs)]
+        write_took = [self.new_store(int(expected * (1 - read_fraction)) // write_block + 1) for _ in range(self.jobs)]
+        flushed = [0] * self.jobs
+        moved = [0] * self.jobs  # bytes per worker, one slot each so no lock is needed
+        ops = [0] * self.jobs
+        stop = self.stopped
+        limit = self.limiter
+        direct = self.direct
+
+        def worker(n, barrier):
+            f = self.open('rw' if read_fraction else 'write')
+            read_offsets = self.offsets(file_size, read_block, sequential, n * (file_size // read_block) // self.jobs)
+            write_offsets = self.offsets(file_size, write_block, sequential, n * (file_size // write_block) // self.jobs)
+            blocks = self.pool.cursor(write_block, n * len(self.pool.buffer) // self.jobs)
+            if direct:
+                buff = mmap.mmap(-1, read_block)  # O_DIRECT needs an aligned buffer
+            reads, writes = read_took[n], write_took[n]
+            read_samples, write_samples = reads.values, writes.values
+            read_stamps, write_stamps = reads.stamps, writes.stamps
+            read_capacity, write_capacity = reads.capacity(), writes.capacity()
+            r = w = 0
+            try:
+                barrier.wait()
+                begin = end = time()
+                while moved[n] < budget and not stop[0] and (not runtime or end - begin < runtime):
+                    if random() < read_fraction:
+                        offset = next(read_offsets)
+                        if limit is not None:
+                            limit.take(read_block)
+                        if direct:
+                            start = time()
+                            os.preadv(f, [buff], offset)
+                            end = time()
+                        else:
+                            start = time()
+                            os.pread(f, read_block, offset)
+                            end = time()
+                        if r == read_capacity:
+                            read_capacity = reads.grow()
+                        read_samples[r] = end - start
+                        read_stamps[r] = end
+                        r += 1
+                        moved[n] += read_block
+                        ops[n] += 1
+                    else:
+                        offset = next(write_offsets)
+                        data = next(blocks)
+                        if limit is not None:
+                            limit.take(write_block)
+                        start = time()
+                        os.pwrite(f, data, offset)
+                        end = time()
+                        if every and (w + 1) % every == 0:
+                            sync(f)  # force write to disk
+                            flush = time() - end
+                            flushed[n] += flush
+                            end += flush
+                        if w == write_capacity:
+                            write_capacity = writes.grow()
+                        write_samples[w] = end - start
+                        write_stamps[w] = end
+                        w += 1
+                        moved[n] += write_block
+                        ops[n] += 1
+                reads.count, writes.count = r, w
+                if w:
+                    flushed[n] += self.final_flush(f)
+            finally:
+                os.close(f)
+
+        if runtime:
+            started = time()
+            progress = lambda: (time() - started) * 100 / runtime
+        else:
+            progress = lambda: sum(moved) * 100 / file_size
+        wall = self.run_workers(worker, self.jobs, self.workload, progress, show_progress, update_pb,
+                                lambda: (sum(ops), sum(moved)))
+
+        self.read_took = type(read_took[0]).merge(read_took)
+        self.write_took = type(write_took[0]).merge(write_took)
+        self.read_worker_took, self.write_worker_took = read_took, write_took
+        self.read_blocks, self.write_blocks = len(self.read_took), len(self.write_took)
+        self.read_time = self.write_time = wall
+        self.write_flush_time = sum(flushed)
+        self.read_bytes = len(self.read_took) * read_block
+        self.write_bytes = len(self.write_took) * write_block
 
     def print_result(self):
-        result = ('\n\nWritten {} MB in {:.4f} s\nWrite speed is  {:.2f} MB/s'
-                  '\n  max: {max:.2f}, min: {min:.2f}\n'.format(
-            self.write_mb, sum(self.write_results), self.write_mb / sum(self.write_results),
-            max=self.write_block_kb / (1024 * min(self.write_results)),
-            min=self.write_block_kb / (1024 * max(self.write_results))))
-        result += ('\nRead {} x {} B blocks in {:.4f} s\nRead speed is  {:.2f} MB/s'
-                   '\n  max: {max:.2f}, min: {min:.2f}\n'.format(
-            len(self.read_results), self.read_block_b,
-            sum(self.read_results), self.write_mb / sum(self.read_results),
-            max=self.read_block_b / (1024 * 1024 * min(self.read_results)),
-            min=self.read_block_b / (1024 * 1024 * max(self.read_results))))
-        print(result)
+        print(self.return_result())
+        if hasattr(self, 'sweep_results'):
+            print(self.sweep_result())
+        if hasattr(self, 'trials'):
+            print(self.trials_result())
+        print(self.histogram_result())
         print(ASCIIART)
 
+    def latency_stats(self, took, elapsed):
+        '''
+        Summarises a phase: IOPS over elapsed sec, latency mean, stddev,
+        min, max and PERCENTILES in ms, and the log-scale histogram.
+        The keys are always present, so the JSON schema is stable.
+        '''
+        stats = {'Samples': len(took), 'IOPS': round(len(took) / elapsed, 2) if elapsed else 0}
+        keys = ['p{:g}'.format(p) for p in self.PERCENTILES]
+        if not len(took):
+            stats.update({'Mean (ms)': 0, 'Stddev (ms)': 0, 'Min (ms)': 0, 'Max (ms)': 0,
+                          'Percentiles (ms)': dict.fromkeys(keys, 0), 'Histogram': []})
+            return stats
+        stats['Mean (ms)'] = round(1000 * took.mean(), 6)
+        stats['Stddev (ms)'] = round(1000 * took.stddev(), 6)
+        stats['Min (ms)'] = round(1000 * took.min(), 6)
+        stats['Max (ms)'] = round(1000 * took.max(), 6)
+        stats['Percentiles (ms)'] = dict(zip(keys, (round(1000 * v, 6) for v in took.percentiles(self.PERCENTILES))))
+        stats['Histogram'] = [{'Upper bound (ms)': 1000 * upper, 'Count': n} for upper, n in took.log_histogram()]
+        return stats
+
+    def series_stats(self, took, block_size):
+        '''
+        Throughput per interval of the phase, the first window of
+        STEADY_WINDOW intervals that is steady (range and slope within
+        STEADY_RANGE and STEADY_SLOPE of its mean) and every cliff, where
+        the mean of the next CLIFF_WINDOW intervals drops below CLIFF_DROP
+        of the previous ones. The last, partial interval is left out of
+        the analysis.
+        '''
+        speeds, iops = took.time_series(block_size, self.interval)
+        stats = {'Interval (sec)': self.interval, 'MB/s': [round(float(v), 2) for v in speeds],
+                 'IOPS': [round(float(v), 2) for v in iops], 'Steady state': None, 'Cliffs': []}
+        full = speeds[:-1]
+        window = self.STEADY_WINDOW
+        middle = (window - 1) / 2
+        spread = sum((x - middle) ** 2 for x in range(window))
+        for i in range(len(full) - window + 1):
+            y = full[i:i + window]
+            mean = fsum(y) / window
+            if not mean or max(y) - min(y) > self.STEADY_RANGE * mean:
+                continue
+            slope = fsum((x - middle) * (v - mean) for x, v in enumerate(y)) / spread  # least squares
+            if abs(slope) * (window - 1) <= self.STEADY_SLOPE * mean:
+                stats['Steady state'] = {'From (sec)': round(i * self.interval, 3), 'MB/s': round(mean, 2)}
+                break
+        window = self.CLIFF_WINDOW
+
+        def average(start):
+            return fsum(full[start:start + window]) / window
+
+        def drop(i):
+            before = average(i - window)
+            return average(i) / before if before > 0 else 1  # nothing to drop from after a stall
+
+        i = window
+        while i <= len(full) - window:
+            if drop(i) < self.CLIFF_DROP:
+                # the windows straddle the cliff for a while, pin it to the sharpest drop
+                i = min(range(i, min(i + window, len(full) - window + 1)), key=drop)
+                before, after = average(i - window), average(i)
+                stats['Cliffs'].append({'At (sec)': round(i * self.interval, 3),
+                                        'Before MB/s': round(float(before), 2), 'After MB/s': round(float(after), 2)})
+                i += window
+            else:
+                i += 1
+        return stats
+
+    def series_result(self, stats):
+        if not stats['MB/s']:
+            return ''
+        result = ''
+        steady = stats['Steady state']
+        if steady is not None:
+            result += '  steady state from {:.1f} s at {:.2f} MB/s\n'.format(steady['From (sec)'], steady['MB/s'])
+        elif len(stats['MB/s']) > self.STEADY_WINDOW:
+            result += '  no steady state reached\n'
+        for cliff in stats['Cliffs']:
+            result += '  throughput cliff at {:.1f} s: {:.2f} -> {:.2f} MB/s\n'.format(
+                cliff['At (sec)'], cliff['Before MB/s'], cliff['After MB/s'])
+        return result
+
+    def overhead_share(self, took):
+        '''Calibrated bookkeeping time per block over the mean latency of took, 0 without samples.'''
+        if not len(took) or not took.mean():
+            return 0
+        return self.overhead / took.mean()
+
+    def overhead_result(self, took):
+        share = self.overhead_share(took)
+        if not share:
+            return ''
+        result = '  interpreter overhead: {:.3f} us/block, {:.1%} of the mean latency\n'.format(1e6 * self.overhead, share)
+        if share > self.OVERHEAD_WARN:
+            result += '  the tool is likely the bottleneck here{}\n'.format(
+                ', try a larger --batch' if self.workload == 'write-read' and self.engine == 'sync' else '')
+        return result
+
+    def stats_result(self, stats):
+        return ('  IOPS: {:.0f}, latency mean: {:.3f} ms, stddev: {:.3f} ms\n  {}\n'.format(
+            stats['IOPS'], stats['Mean (ms)'], stats['Stddev (ms)'],
+            ', '.join('{}: {:.3f}'.format(k, v) for k, v in stats['Percentiles (ms)'].items()) + ' ms'))
+
+    def histogram_result(self, width=40):
+        result = ''
+        for name, took, elapsed in (('Write', self.write_results, self.write_time),
+                                    ('Read', self.read_results, self.read_time)):
+            histogram = self.latency_stats(took, elapsed)['Histogram']
+            if not histogram:
+                continue
+            result += '\n{} latency histogram\n'.format(name)
+            most = max(bucket['Count'] for bucket in histogram)
+            for bucket in histogram:
+                result += '  <= {:>10.4f} ms |{:<{width}}| {}\n'.format(
+                    bucket['Upper bound (ms)'], '#' * int(round(width * bucket['Count'] / most)),
+                    bucket['Count'], width=width)
+        return result
+
     def return_result(self):
-        result = ('\n\nWritten {} MB in {:.4f} s\nWrite speed is  {:.2f} MB/s'
-                  '\n  max: {max:.2f}, min: {min:.2f}\n'.format(
-            self.write_mb, sum(self.write_results), self.write_mb / sum(self.write_results),
-            max=self.write_block_kb / (1024 * min(self.write_results)),
-            min=self.write_block_kb / (1024 * max(self.write_results))))
-        result += ('\nRead {} x {} B blocks in {:.4f} s\nRead speed is  {:.2f} MB/s'
-                   '\n  max: {max:.2f}, min: {min:.2f}\n'.format(
-            len(self.read_results), self.read_block_b,
-            sum(self.read_results), self.write_mb / sum(self.read_results),
-            max=self.read_block_b / (1024 * 1024 * min(self.read_results)),
-            min=self.read_block_b / (1024 * 1024 * max(self.read_results))))
+        result = '\n'
+        if self.limiter is not None:
+            result += '\nRate limited to {} (speeds include the waits, latencies do not)\n'.format(' and '.join(
+                limit for limit in ('{:g} MB/s'.format(self.rate_mb) if self.rate_mb else '',
+                                    '{:g} IOPS'.format(self.rate_iops) if self.rate_iops else '') if limit))
+        if self.preallocate is not None:
+            result += '\nPreallocated {:g} MB ({}) in {:.4f} s\n'.format(self.write_mb, self.preallocate,
+                                                                      self.preallocate_time)
+            result += self.usage_result(self.usage.get('Preallocate'))
+        if len(self.write_results):
+            result += ('\nWritten {:g} MB in {:.4f} s\nWrite speed is  {:.2f} MB/s'
+                       '\n  max: {max:.2f}, min: {min:.2f}\n'.format(
+                self.write_bytes / (1024 * 1024), self.write_time, mb_per_sec(self.write_bytes, self.write_time),
+                max=self.write_block_kb / (1024 * self.write_results.min()),
+                min=self.write_block_kb / (1024 * self.write_results.max())))
+            result += '  flushing ({}): {:.4f} s\n'.format(self.sync, self.write_flush_time)
+            result += self.stats_result(self.latency_stats(self.write_results, self.write_time))
+            result += self.series_result(self.series_stats(self.write_results, 1024 * self.write_block_kb))
+            result += self.overhead_result(self.write_results)
+            result += self.usage_result(self.usage.get('Write'))
+            result += self.jobs_result(self.write_worker_took, 1024 * self.write_block_kb)
+        if len(self.read_results):
+            result += ('\nRead {} x {} B blocks in {:.4f} s\nRead speed is  {:.2f} MB/s'
+                       '\n  max: {max:.2f}, min: {min:.2f}\n'.format(
+                len(self.read_results), self.read_block,
+                self.read_time, mb_per_sec(self.read_bytes, self.read_time),
+                max=self.read_block / (1024 * 1024 * self.read_results.min()),
+                min=self.read_block / (1024 * 1024 * self.read_results.max())))
+            result += self.stats_result(self.latency_stats(self.read_results, self.read_time))
+            result += self.series_result(self.series_stats(self.read_results, self.read_block))
+            result += self.overhead_result(self.read_results)
+            result += self.usage_result(self.usage.get('Read'))
+            result += self.jobs_result(self.read_worker_took, self.read_block)
+        if self.workload in self.usage:
+            result += '\n{} phase (reads and writes together)\n'.format(self.workload)
+            result += self.usage_result(self.usage[self.workload])
 
         return result
 
+    def usage_result(self, usage):
+        if not usage:
+            return ''
+        result = ''
+        if 'User CPU (sec)' in usage:
+            result += ('  cpu: {:.3f} s user, {:.3f} s sys ({:.0f}% of the wall time), '
+                       'context switches: {} voluntary, {} involuntary\n'.format(
+                usage['User CPU (sec)'], usage['System CPU (sec)'], usage['CPU (% of wall time)'],
+                usage['Voluntary context switches'], usage['Involuntary context switches']))
+        io = usage['Process I/O']
+        if io is not None:
+            result += '  process I/O: {:.2f} MB read, {:.2f} MB written, {} read and {} write syscalls\n'.format(
+                io['Read bytes'] / (1024 * 1024), io['Write bytes'] / (1024 * 1024),
+                io['Read syscalls'], io['Write syscalls'])
+        elif 'Blocks in' in usage:
+            result += '  block I/O: {} blocks in, {} blocks out\n'.format(usage['Blocks in'], usage['Blocks out'])
+        device = usage['Device']
+        if device is not None:
+            result += ('  device {}: {} reads ({} merged), {} writes ({} merged), await {:.3f} ms, '
+                       'busy {:.0f}%, queue depth {:.2f}\n'.format(
+                device['Name'], device['Reads'], device['Reads merged'], device['Writes'],
+                device['Writes merged'], device['Await (ms)'], device['Busy (%)'], device['Average queue depth']))
+        return result
+
+    def jobs_result(self, worker_took, block_size):
+        if len(worker_took) < 2:
+            return ''
+        result = ''
+        for n, took in enumerate(worker_took):
+            if not took:
+                continue
+            result += '  job {}: {} blocks, {:.2f} MB/s, mean latency {:.3f} ms\n'.format(
+                n, len(took), mb_per_sec(len(took) * block_size, took.total()), 1000 * took.total() / len(took))
+        return result
+
+    def latency_sample(self, took):
+        '''Up to SAMPLE_KEEP latencies in ms picked at random from took, [] for histogram stores.'''
+        if not isinstance(took, SampleStore) or not len(took):
+            return []
+        if len(took) > self.SAMPLE_KEEP:
+            values = [took.values[i] for i in sample(range(len(took)), self.SAMPLE_KEEP)]
+        else:
+            values = list(took)
+        return [round(1000 * v, 6) for v in values]
+
+    def record(self, config, label=None):
+        '''
+        The run as a --store record: when and where it ran, its settings,
+        the JSON result and a latency sample per phase for compare.
+        '''
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return {'Id': '{:%Y%m%d-%H%M%S}-{}'.format(now, os.urandom(2).hex()), 'Time': now.isoformat(),
+                'Label': label, 'Host': host_metadata(self.file), 'Config': config,
+                'Result': self.json_result(),
+                'Write latency sample (ms)': self.latency_sample(self.write_results),
+                'Read latency sample (ms)': self.latency_sample(self.read_results)}
 
     def get_json_result(self,output_file):
+        with open(output_file,'w') as f:
+            json.dump(self.json_result(),f)
+
+    def json_result(self):
         results_json = {}
-        results_json["Written MB"] = self.write_mb
-        results_json["Write time (sec)"] = round(sum(self.write_results),2)
-        results_json["Write speed in MB/s"] = round(self.write_mb / sum(self.write_results),2)
+        results_json["Workload"] = self.workload
+        results_json["Written MB"] = round(self.write_bytes / (1024 * 1024),2)
+        results_json["Write time (sec)"] = round(self.write_time,2)
+        results_json["Write speed in MB/s"] = round(mb_per_sec(self.write_bytes, self.write_time),2)
         results_json["Read blocks"] = len(self.read_results)
-        results_json["Read time (sec)"] = round(sum(self.read_results),2)
-        results_json["Read speed in MB/s"] = round(self.write_mb / sum(self.read_results),2)
-        with open(output_file,'w') as f:
-            json.dump(results_json,f)
+        results_json["Read block size (B)"] = self.read_block
+        results_json["Read time (sec)"] = round(self.read_time,2)
+        results_json["Read speed in MB/s"] = round(mb_per_sec(self.read_bytes, self.read_time),2)
+        results_json["Jobs"] = self.jobs
+        results_json["Engine"] = self.engine
+        results_json["Payload"] = self.payload
+        results_json["Direct I/O"] = self.direct
+        results_json["Sync policy"] = self.sync
+        results_json["Flush time (sec)"] = round(self.write_flush_time,2)
+        results_json["Batch"] = self.batch
+        results_json["Rate limit"] = {'MB/s': self.rate_mb, 'IOPS': self.rate_iops}
+        results_json["Interpreter overhead (us per block)"] = round(1e6 * self.overhead, 3)
+        results_json["Resource usage"] = self.usage
+        results_json["Preallocation"] = ({'Mode': self.preallocate, 'Time (sec)': round(self.preallocate_time, 4)}
+                                         if self.preallocate is not None else None)
+        results_json["Interpreter overhead share"] = {'Write': round(self.overhead_share(self.write_results), 4),
+                                                      'Read': round(self.overhead_share(self.read_results), 4)}
+        if self.jobs > 1:
+            results_json["Per-job write speed in MB/s"] = [
+                round(mb_per_sec(len(took) * 1024 * self.write_block_kb, took.total()), 2)
+                for took in self.write_worker_took]
+            results_json["Per-job read speed in MB/s"] = [
+                round(mb_per_sec(len(took) * self.read_block, took.total()), 2)
+                for took in self.read_worker_took]
+        results_json["Write latency"] = self.latency_stats(self.write_results, self.write_time)
+        results_json["Read latency"] = self.latency_stats(self.read_results, self.read_time)
+        results_json["Write time series"] = self.series_stats(self.write_results, 1024 * self.write_block_kb)
+        results_json["Read time series"] = self.series_stats(self.read_results, self.read_block)
+        if hasattr(self, 'sweep_results'):
+            results_json["Sweep"] = self.sweep_results
+        if hasattr(self, 'trials'):
+            results_json["Warmup trials"] = self.warmup
+            results_json["Trials"] = self.trials
+            results_json["Trial summary"] = self.trials_summary()
+        return results_json
 
 class benchmark_gui:
+    POLL_MS = 100
+    LIVE_POINTS = 100  # rolling window of the live chart, in polls
+
     def __init__(self, master, file, write_mb, write_block_kb, read_block_b):
         self.master = master
         self.master.title('Monkey Test')
@@ -318,23 +2480,97 @@ class benchmark_gui:
         for widget in self.main_frame.winfo_children():
             widget.destroy()
 
-        perc_comp_pb = ttk.Progressbar(self.main_frame, orient="horizontal", length=200, mode="determinate")
-        perc_comp_pb["maximum"] = 100
-        perc_comp_pb.grid(row=1, column=0, padx=5, pady=5)
-
-
-        benchmark = Benchmark(file,write_mb, write_block_kb, read_block_b)
-        self.benchmark = benchmark
-        run_lb = ttk.Label(self.main_frame, text='Running...')
-        run_lb.grid(row=0, column=0, padx=5, pady=5)
+        self.run_lb = ttk.Label(self.main_frame, text='Running...')
+        self.run_lb.grid(row=0, column=0, padx=5, pady=5)
+        self.perc_comp_pb = ttk.Progressbar(self.main_frame, orient="horizontal", length=200, mode="determinate")
+        self.perc_comp_pb["maximum"] = 100
+        self.perc_comp_pb.grid(row=1, column=0, padx=5, pady=5)
         if self.show_progress.get():
-            benchmark.run(update_pb=perc_comp_pb, show_progress=False)
-        if not self.show_progress.get():
-            benchmark.run(show_progress=False)
+            self.live = deque(maxlen=self.LIVE_POINTS)
+            self.last_status = None
+            self.started = time()
+            self.figure = Figure(figsize=(5, 3), dpi=100)
+            self.mbps_axes = self.figure.add_subplot(111)
+            self.iops_axes = self.mbps_axes.twinx()
+            self.mbps_line, = self.mbps_axes.plot([], [], color='tab:blue', label='MB/s')
+            self.iops_line, = self.iops_axes.plot([], [], color='tab:orange', label='IOPS')
+            self.mbps_axes.set_xlabel('Time (s)')
+            self.mbps_axes.set_ylabel('MB/s')
+            self.iops_axes.set_ylabel('IOPS')
+            self.figure.tight_layout()
+            self.canvas = FigureCanvasTkAgg(self.figure, master=self.main_frame)
+            self.canvas.get_tk_widget().grid(row=2, column=0, padx=5, pady=5)
+        self.cancel_bt = ttk.Button(self.main_frame, text='Cancel', command=self.cancel)
+        self.cancel_bt.grid(row=3, column=0, padx=5, pady=5)
 
-        perc_comp_pb.destroy()
-        run_lb.destroy()
+        self.file = file
+        self.benchmark = Benchmark(file,write_mb, write_block_kb, read_block_b)
+        self.outcome = queue.Queue()
+        worker = threading.Thread(target=self.work)
+        worker.daemon = True
+        worker.start()
+        self.master.after(self.POLL_MS, self.poll)
+
+    def work(self):
+        '''Runs the benchmark off the Tk thread and queues how it ended.'''
+        try:
+            self.benchmark.run(show_progress=False)
+            self.outcome.put(('done', None))
+        except BenchmarkCancelled:
+            self.outcome.put(('cancelled', None))
+        except Exception as e:
+            self.outcome.put(('error', e))
+
+    def poll(self):
+        status = dict(self.benchmark.status)
+        self.perc_comp_pb["value"] = status['percent']
+        if status['phase'] is not None and not self.benchmark.stopped[0]:
+            self.run_lb.configure(text='{}: {:.2f} %'.format(status['phase'], status['percent']))
+        if self.show_progress.get():
+            self.update_chart(status)
+        try:
+            outcome, error = self.outcome.get_nowait()
+        except queue.Empty:
+            self.master.after(self.POLL_MS, self.poll)
+            return
+        self.finish(outcome, error)
+
+    def update_chart(self, status):
+        '''Adds the MB/s and IOPS since the previous poll to the live chart.'''
+        last, self.last_status = self.last_status, status
+        if last is None or last['phase'] != status['phase'] or status['elapsed'] <= last['elapsed']:
+            return
+        took = status['elapsed'] - last['elapsed']
+        self.live.append((time() - self.started,
+                          (status['bytes'] - last['bytes']) / (1024 * 1024 * took),
+                          (status['ops'] - last['ops']) / took))
+        x, mbps, iops = zip(*self.live)
+        self.mbps_line.set_data(x, mbps)
+        self.iops_line.set_data(x, iops)
+        for axes in (self.mbps_axes, self.iops_axes):
+            axes.relim()
+            axes.autoscale_view()
+        self.canvas.draw_idle()
+
+    def cancel(self):
+        self.benchmark.cancel()
+        self.cancel_bt.configure(state="disabled")
+        self.run_lb.configure(text='Cancelling...')
+
+    def finish(self, outcome, error):
+        for widget in self.main_frame.winfo_children():
+            widget.destroy()
+        if outcome != 'done':
+            if os.path.isfile(self.file):
+                os.remove(self.file)
+            if outcome == 'cancelled':
+                messagebox.showinfo('Cancelled', 'The test was cancelled and its file deleted')
+            else:
+                messagebox.showerror('Monkey Test Failed', str(error))
+            self.initialize()
+            return
 
+        benchmark, file = self.benchmark, self.file
         show_results = tk.Message(self.main_frame, text=benchmark.return_result(), justify='center')
         show_results.grid(columnspan=2, row=0, column=0)
 
@@ -344,24 +2580,33 @@ class benchmark_gui:
         self.write_graph.grid(row=1, column=1)
         ttk.Button(self.main_frame, text='Save JSON File', command=lambda: benchmark.get_json_result(filedialog.asksaveasfilename(initialdir = "~",title = "Save As", defaultextension='.json'))).grid(row=2, column=0)
         ttk.Button(self.main_frame, text='Delete File', command=lambda: os.remove(file)).grid(row=2, column=1)
+        ttk.Button(self.main_frame, text='Throughput Graph', command=lambda: self.plot_series(benchmark)).grid(row=3, column=0, columnspan=2)
         benchmark.print_result()
 
+    @staticmethod
+    def percent_complete(took, blocks_count):
+        '''Percent complete after each stored block, derived from its index.'''
+        return [(i + 1) * 100 / blocks_count for i in range(len(took))]
+
     @classmethod
     def plot(self, rw, benchmark, button=False, show=True):
+        if not isinstance(benchmark.write_took, SampleStore):
+            print('Graphs need per-block samples, run without --histogram')
+            return
         if rw == 'Read':
             if button is not False: button.configure(state="disabled")
-            x = [0] + benchmark.read_took
-            y = [0] + benchmark.rperc_took
-            plt.plot(np.cumsum(x), y, label='Read')
+            x = [0] + list(benchmark.read_took)
+            y = [0] + self.percent_complete(benchmark.read_took, benchmark.read_blocks)
+            plt.plot(list(accumulate(x)), y, label='Read')
             if plt.gca().get_title() == '':
                 plt.title('Read Graph')
             else:
                 plt.title('Write/Read Graph')
         elif rw == 'Write':
             if button is not False: button.configure(state="disabled")
-            x = [0] + benchmark.write_took
-            y = [0] + benchmark.wperc_took
-            plt.plot(np.cumsum(x), y, label='Write')
+            x = [0] + list(benchmark.write_took)
+            y = [0] + self.percent_complete(benchmark.write_took, benchmark.write_blocks)
+            plt.plot(list(accumulate(x)), y, label='Write')
             if plt.gca().get_title() == '':
                 plt.title('Write Graph')
             else:
@@ -372,14 +2617,637 @@ class benchmark_gui:
         plt.xlabel('Time taken (x)')
         if show: plt.show()
 
+    @classmethod
+    def plot_sweep(self, benchmark, show=True):
+        '''Read MB/s (top) and p99 latency (bottom) against block size, a line per queue depth.'''
+        figure = plt.gcf()
+        figure.set_size_inches(8, 8)
+        speed_axes = figure.add_subplot(2, 1, 1)
+        p99_axes = figure.add_subplot(2, 1, 2, sharex=speed_axes)
+        for jobs in sorted(set(row['Jobs'] for row in benchmark.sweep_results)):
+            rows = [row for row in benchmark.sweep_results if row['Jobs'] == jobs]
+            sizes = [row['Block size (B)'] for row in rows]
+            speed_axes.plot(sizes, [row['Read speed in MB/s'] for row in rows], marker='o', label='{} jobs'.format(jobs))
+            p99_axes.plot(sizes, [row['p99 (ms)'] for row in rows], marker='o', label='{} jobs'.format(jobs))
+        speed_axes.set_xscale('log', base=2)
+        speed_axes.set_title('Read Block Size Sweep')
+        speed_axes.set_ylabel('MB/s')
+        speed_axes.legend(loc='upper left')
+        p99_axes.set_ylabel('p99 latency (ms)')
+        p99_axes.set_xlabel('Block size')
+        sizes = sorted(set(row['Block size (B)'] for row in benchmark.sweep_results))
+        p99_axes.set_xticks(sizes)
+        p99_axes.set_xticklabels([format_size(size) for size in sizes], rotation=45)
+        figure.tight_layout()
+        if show: plt.show()
+
+    @classmethod
+    def plot_series(self, benchmark, show=True):
+        '''MB/s per --interval over the run, with steady state and cliffs marked.'''
+        axes = plt.gcf().add_subplot(1, 1, 1)
+        for name, took, block_size in (('Write', benchmark.write_results, 1024 * benchmark.write_block_kb),
+                                       ('Read', benchmark.read_results, benchmark.read_block)):
+            stats = benchmark.series_stats(took, block_size)
+            if not stats['MB/s']:
+                continue
+            seconds = [benchmark.interval * i for i in range(len(stats['MB/s']))]
+            line, = axes.plot(seconds, stats['MB/s'], label=name)
+            if stats['Steady state'] is not None:
+                axes.axvline(stats['Steady state']['From (sec)'], color=line.get_color(), linestyle='--')
+            for cliff in stats['Cliffs']:
+                axes.axvline(cliff['At (sec)'], color='red', linestyle=':')
+        axes.set_title('Throughput over time')
+        axes.set_xlabel('Seconds into the phase')
+        axes.set_ylabel('MB/s')
+        axes.legend(loc='upper right')
+        if show: plt.show()
+
+
+def new_benchmark(args, file):
+    '''Builds the Benchmark the command line asks for, raising ValueError on bad settings.'''
+    return Benchmark(file, args.size, args.write_block_size, args.read_block_size, args.jobs,
+                     args.payload, args.compress_percent, args.pool_size,
+                     args.direct, args.drop_cache, args.sync, args.sync_every, args.histogram,
+                     workload=args.workload, rwmix_read=args.rwmix_read, distribution=args.distribution,
+                     stride=args.stride, zipf_theta=args.zipf_theta, runtime=args.runtime,
+                     engine=args.engine, interval=args.interval, batch=args.batch,
+                     repeat=args.repeat, warmup=args.warmup, rate_mb=args.rate_mb, rate_iops=args.rate_iops,
+                     preallocate=args.preallocate)
+
+
+def make_benchmark(args, file):
+    '''Builds the Benchmark the command line asks for, or exits on bad settings.'''
+    try:
+        benchmark = new_benchmark(args, file)
+        if args.sweep is not None:
+            args.sweep_sizes = parse_sweep(args.sweep)
+            args.sweep_jobs_list = [int(jobs) for jobs in args.sweep_jobs.split(',')]
+            if min(args.sweep_jobs_list) <= 0:
+                raise ValueError('--sweep-jobs must be greater than 0')
+            if benchmark.engine == 'mmap' and max(args.sweep_jobs_list) > 1:
+                raise ValueError('The mmap engine runs on a single thread, --sweep-jobs does not apply')
+            if args.repeat > 1 or args.warmup:
+                raise ValueError('--repeat and --warmup do not apply to --sweep')
+            if args.workload != 'write-read' or args.batch > 1:
+                raise ValueError('--sweep runs the write-read workload; --workload and --batch do not apply to it')
+    except ValueError as e:
+        print('{red}ERROR:{end} {}'.format(e, end=col.Style.RESET_ALL, red=col.Fore.RED))
+        exit()
+    if benchmark.engine_fallback is not None:
+        print('{yellow}Engine {} is not available here, falling back to{end} {red}sync{end}'.format(
+            benchmark.engine_fallback, yellow=col.Fore.YELLOW, end=col.Style.RESET_ALL, red=col.Fore.RED))
+    return benchmark
+
+
+def run_benchmark(args, benchmark):
+    '''Runs the benchmark (or the sweep), reports it and deletes the test file.'''
+    try:
+        if args.sweep is not None:
+            benchmark.sweep_test(args.sweep_sizes, args.sweep_jobs_list)
+        else:
+            benchmark.run()
+    except ValueError as e:
+        print('{red}ERROR:{end} {}'.format(e, end=col.Style.RESET_ALL, red=col.Fore.RED))
+        exit()
+    finally:
+        if os.path.isfile(benchmark.file):
+            os.remove(benchmark.file)
+    if args.json is not None:
+        benchmark.get_json_result(args.json)
+    else:
+        benchmark.print_result()
+    if args.store is not None:
+        append_records(args.store, [benchmark.record(run_config(args), args.label)])
+    if args.sweep is not None:
+        try:
+            load_plotting()
+        except ImportError:
+            print('{yellow}matplotlib is not installed, not saving the sweep graph{end}'.format(
+                yellow=col.Fore.YELLOW, end=col.Style.RESET_ALL))
+            return
+        plt.clf()
+        benchmark_gui.plot_sweep(benchmark, show=False)
+        plt.savefig(os.path.join(args.graph_file, 'sweep.png'))
+
+
+def run_target(args, file, cpus, barrier, reports):
+    '''
+    Process body of run_targets: pins itself to cpus, runs the benchmark
+    on file and puts a report dict on the reports queue, even when it
+    fails. The calibration, payload pool and file setup happen first;
+    only then does it wait for every other target at the barrier, so
+    the first timed phases start together.
+    '''
+    report = {'File': file, 'CPUs': sorted(cpus), 'Error': None}
+    try:
+        if cpus and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpus)
+        benchmark = new_benchmark(args, file)
+        benchmark.ready = barrier.wait
+        benchmark.run(show_progress=False)
+        report['Result'] = benchmark.json_result()
+        report['Write bytes'], report['Read bytes'] = benchmark.write_bytes, benchmark.read_bytes
+        report['Write time'], report['Read time'] = benchmark.write_time, benchmark.read_time
+        report['Write window'] = benchmark.write_results.window()
+        report['Read window'] = benchmark.read_results.window()
+        if args.store is not None:
+            report['Record'] = benchmark.record(run_config(args, file), args.label)
+    except Exception as e:
+        barrier.abort()  # don't leave the other targets waiting for this one
+        report['Error'] = str(e) or type(e).__name__
+    finally:
+        if os.path.isfile(file):
+            os.remove(file)
+        reports.put(report)
+
+
+def target_cpus(count):
+    '''Splits the CPUs this process may run on into count disjoint sets (shared when there are too few).'''
+    if not hasattr(os, 'sched_getaffinity'):
+        return [set() for _ in range(count)]
+    cpus = sorted(os.sched_getaffinity(0))
+    if count > len(cpus):
+        return [{cpus[n % len(cpus)]} for n in range(count)]
+    share = len(cpus) // count
+    return [set(cpus[n * share:(n + 1) * share]) for n in range(count)]
+
+
+def aggregate_targets(reports):
+    '''
+    Adds the targets up per phase. Speed is the combined bytes over the
+    span from the first target starting the phase to the last finishing
+    it, so a saturated controller shows as less than the sum of targets.
+    '''
+    aggregate = {}
+    done = [report for report in reports if report['Error'] is None]
+    for phase in ('Write', 'Read'):
+        moved = sum(report[phase + ' bytes'] for report in done)
+        windows = [report[phase + ' window'] for report in done if report[phase + ' bytes']]
+        if windows and None not in windows:
+            span = max(end for _, end in windows) - min(begin for begin, _ in windows)
+        else:  # --histogram keeps no completion times, the targets started together
+            span = max([report[phase + ' time'] for report in done] or [0])
+        aggregate[phase] = {'MB': round(moved / (1024 * 1024), 2), 'Time (sec)': round(span, 4),
+                            'Speed in MB/s': round(mb_per_sec(moved, span), 2),
+                            'Sum of target speeds in MB/s': round(sum(
+                                mb_per_sec(report[phase + ' bytes'], report[phase + ' time']) for report in done), 2)}
+    aggregate['Targets'] = len(reports)
+    aggregate['Failed'] = len(reports) - len(done)
+    return aggregate
+
+
+def run_targets(args):
+    '''
+    Benchmarks every --file at once, one process per target pinned to
+    its own CPUs and released together from a barrier, then reports each
+    target and the aggregate.
+    '''
+    if args.sweep is not None:
+        print('{red}ERROR:{end} --sweep runs on a single --file'.format(end=col.Style.RESET_ALL, red=col.Fore.RED))
+        exit()
+    if len(set(args.file)) != len(args.file):
+        print('{red}ERROR:{end} the same --file is given twice'.format(end=col.Style.RESET_ALL, red=col.Fore.RED))
+        exit()
+    for file in args.file:
+        make_benchmark(args, file)  # exits on bad settings before any process starts
+    import multiprocessing
+    barrier = multiprocessing.Barrier(len(args.file) + 1)
+    reports = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=run_target, args=(args, file, cpus, barrier, reports))
+                 for file, cpus in zip(args.file, target_cpus(len(args.file)))]
+    for process in processes:
+        process.start()
+    print('Benchmarking {} targets in parallel...'.format(len(processes)))
+    try:
+        barrier.wait()
+    except threading.BrokenBarrierError:
+        pass  # a target failed to start, its report says why
+    results = [reports.get() for _ in processes]
+    for process in processes:
+        process.join()
+    results.sort(key=lambda report: args.file.index(report['File']))
+    aggregate = aggregate_targets(results)
+    if args.store is not None:
+        append_records(args.store, [report['Record'] for report in results if 'Record' in report])
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'Targets': [{key: report[key] for key in ('File', 'CPUs', 'Error', 'Result') if key in report}
+                                   for report in results], 'Aggregate': aggregate}, f)
+        return
+    print(targets_result(results, aggregate))
+
+
+def targets_result(reports, aggregate):
+    result = '\n{:<30} {:>8} {:>11} {:>11} {:>11} {:>14}\n'.format(
+        'Target', 'CPUs', 'Write MB/s', 'Read MB/s', 'Read IOPS', 'Read p99 (ms)')
+    for report in reports:
+        cpus = ','.join(str(cpu) for cpu in report['CPUs']) or '-'
+        if report['Error'] is not None:
+            result += '{:<30} {:>8} {red}failed:{end} {}\n'.format(
+                report['File'], cpus, report['Error'], end=col.Style.RESET_ALL, red=col.Fore.RED)
+            continue
+        stats = report['Result']
+        result += '{:<30} {:>8} {:>11.2f} {:>11.2f} {:>11.0f} {:>14.3f}\n'.format(
+            report['File'], cpus, stats['Write speed in MB/s'], stats['Read speed in MB/s'],
+            stats['Read latency']['IOPS'], stats['Read latency']['Percentiles (ms)']['p99'])
+    result += '{:<30} {:>8} {:>11.2f} {:>11.2f}\n'.format(
+        'Aggregate', '', aggregate['Write']['Speed in MB/s'], aggregate['Read']['Speed in MB/s'])
+    result += '{:<30} {:>8} {:>11.2f} {:>11.2f}\n'.format(
+        '  sum of targets', '', aggregate['Write']['Sum of target speeds in MB/s'],
+        aggregate['Read']['Sum of target speeds in MB/s'])
+    return result
+
+
+def run_config(args, file=None):
+    '''The settings of a run as stored with it, for a single target file when given.'''
+    config = {key: value for key, value in vars(args).items() if key not in ('json', 'store', 'label', 'graph_file')}
+    config['file'] = file if file is not None else args.file[0]
+    return config
+
+
+def read_sys(path):
+    '''Stripped contents of a sysfs file, or None.'''
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def host_metadata(file):
+    '''
+    Host, kernel, filesystem and device details of where file lives.
+    Fields that can't be found out on this platform are None.
+    '''
+    directory = os.path.dirname(os.path.abspath(file))
+    meta = {'Hostname': platform.node(), 'OS': platform.system(), 'Kernel': platform.release(),
+            'Platform': platform.platform(), 'Python': platform.python_version(), 'CPUs': os.cpu_count(),
+            'Filesystem': None, 'Mount point': None, 'Mount source': None,
+            'Device': None, 'Device model': None, 'Rotational': None}
+    try:
+        with open('/proc/mounts') as f:
+            mounts = [line.split()[:3] for line in f]
+    except OSError:
+        mounts = []
+    for source, point, fstype in sorted(mounts, key=lambda mount: len(mount[1])):  # the deepest mount wins
+        point = point.replace('\\040', ' ')
+        if directory == point or directory.startswith(point.rstrip('/') + '/'):
+            meta['Filesystem'], meta['Mount point'], meta['Mount source'] = fstype, point, source
+    block = block_device(file)
+    if block is not None:
+        if not os.path.isdir(os.path.join(block, 'device')):  # a partition, the disk is its parent
+            block = os.path.dirname(block)
+        meta['Device'] = os.path.basename(block)
+        meta['Device model'] = read_sys(os.path.join(block, 'device', 'model'))
+        rotational = read_sys(os.path.join(block, 'queue', 'rotational'))
+        meta['Rotational'] = rotational == '1' if rotational is not None else None
+    return meta
+
+
+def append_records(store, records):
+    with open(store, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+
+def load_records(store):
+    with open(store) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def find_record(records, key):
+    '''
+    The record whose id starts with key or whose label is key, else
+    records[int(key)]. Raises ValueError when key matches several runs,
+    as the per-target records of a multi-target run do.
+    '''
+    found = [record for record in records if record['Id'].startswith(key) or record.get('Label') == key]
+    if len(found) > 1:
+        raise ValueError('{!r} matches {} runs, give one of their ids: {}'.format(key, len(found), ', '.join(
+            '{} ({})'.format(record['Id'], record.get('Config', {}).get('file')) for record in found)))
+    if found:
+        return found[0]
+    try:
+        return records[int(key)]
+    except (ValueError, IndexError):
+        raise ValueError('No run {!r} in the results file'.format(key))
+
+
+def mann_whitney(a, b):
+    '''
+    Two-sided p value of the Mann-Whitney U test that a and b come from
+    the same distribution, by the normal approximation with tie correction.
+    '''
+    n1, n2 = len(a), len(b)
+    n = n1 + n2
+    ranks, counts, below = {}, [], 0
+    for value, group in groupby(sorted(list(a) + list(b))):
+        count = len(list(group))
+        ranks[value] = below + (count + 1) / 2  # ties share their mean rank
+        counts.append(count)
+        below += count
+    u = fsum(ranks[value] for value in a) - n1 * (n1 + 1) / 2
+    ties = sum(t ** 3 - t for t in counts) / (n * (n - 1))
+    sigma = sqrt(n1 * n2 / 12 * (n + 1 - ties))
+    if not sigma:
+        return 1.0
+    return erfc(abs(u - n1 * n2 / 2) / sigma / sqrt(2))
+
+
+def p99_change(a, b, alpha, resamples=1000):
+    '''Bootstrap (1 - alpha) confidence interval of p99(b) - p99(a).'''
+    rng = Random(0)
+    diffs = sorted(percentile(sorted(rng.choices(b, k=len(b))), 99) -
+                   percentile(sorted(rng.choices(a, k=len(a))), 99) for _ in range(resamples))
+    return percentile(diffs, 50 * alpha), percentile(diffs, 100 - 50 * alpha)
+
+
+def compare_records(baseline, candidate, threshold, alpha):
+    '''
+    Compares every phase both runs have: throughput per --interval with
+    the Mann-Whitney U test, p99 latency with a bootstrap interval of its
+    change. A change counts as a regression when it is worse by more
+    than threshold percent and significant at alpha. Returns the report
+    lines and whether anything regressed.
+    '''
+    lines, regressed = [], False
+    flag = '{red}REGRESSION{end}'.format(red=col.Fore.RED, end=col.Style.RESET_ALL)
+    for key in sorted(set(baseline['Config']) | set(candidate['Config'])):
+        if key != 'file' and baseline['Config'].get(key) != candidate['Config'].get(key):
+            lines.append('  setting {} differs: {} -> {}'.format(key, baseline['Config'].get(key), candidate['Config'].get(key)))
+    for key in ('Kernel', 'Filesystem', 'Device model'):
+        if baseline['Host'].get(key) != candidate['Host'].get(key):
+            lines.append('  {} differs: {} -> {}'.format(key.lower(), baseline['Host'].get(key), candidate['Host'].get(key)))
+    for phase in ('Write', 'Read'):
+        old, new = baseline['Result'], candidate['Result']
+        if not old[phase + ' latency']['Samples'] or not new[phase + ' latency']['Samples']:
+            continue
+        old_speed, new_speed = old[phase + ' speed in MB/s'], new[phase + ' speed in MB/s']
+        change = 100 * (new_speed - old_speed) / old_speed if old_speed else 0
+        old_series, new_series = old[phase + ' time series']['MB/s'][:-1], new[phase + ' time series']['MB/s'][:-1]
+        line = '  {} speed: {:.2f} -> {:.2f} MB/s ({:+.1f}%)'.format(phase, old_speed, new_speed, change)
+        if min(len(old_series), len(new_series)) < 5:
+            line += ', too few intervals to test (run longer or lower --interval)'
+        else:
+            p = mann_whitney(old_series, new_series)
+            line += ', p={:.4f}'.format(p)
+            if change < -threshold and p < alpha:
+                line += ' ' + flag
+                regressed = True
+        lines.append(line)
+        old_p99, new_p99 = old[phase + ' latency']['Percentiles (ms)']['p99'], new[phase + ' latency']['Percentiles (ms)']['p99']
+        change = 100 * (new_p99 - old_p99) / old_p99 if old_p99 else 0
+        line = '  {} p99 latency: {:.3f} -> {:.3f} ms ({:+.1f}%)'.format(phase, old_p99, new_p99, change)
+        old_sample, new_sample = baseline[phase + ' latency sample (ms)'], candidate[phase + ' latency sample (ms)']
+        if min(len(old_sample), len(new_sample)) < 100:
+            line += ', too few latencies kept to test (--histogram runs keep none)'
+        else:
+            low, high = p99_change(old_sample, new_sample, alpha)
+            line += ', {:.0%} CI of the change [{:+.3f}, {:+.3f}] ms'.format(1 - alpha, low, high)
+            if change > threshold and low > 0:
+                line += ' ' + flag
+                regressed = True
+        lines.append(line)
+    return lines, regressed
+
+
+def compare_main(argv):
+    '''The compare subcommand; exits with status 1 when a regression is found.'''
+    args = get_compare_args(argv)
+    try:
+        records = load_records(args.store)
+        runs = getattr(args, 'runs', [])
+        if args.baseline is not None:
+            if len(runs) > 1:
+                raise ValueError('Give a single candidate run with --baseline')
+            keys = [args.baseline, runs[0] if runs else '-1']
+        elif len(runs) == 2 or not runs:
+            keys = runs or ['-2', '-1']
+        else:
+            raise ValueError('Give two runs, or a candidate run and --baseline')
+        baseline, candidate = (find_record(records, key) for key in keys)
+    except (OSError, ValueError) as e:
+        print('{red}ERROR:{end} {}'.format(e, end=col.Style.RESET_ALL, red=col.Fore.RED))
+        sys.exit(2)
+    lines, regressed = compare_records(baseline, candidate, args.threshold, args.alpha)
+    print('Comparing {}{} (baseline) with {}{}'.format(
+        baseline['Id'], ' [{}]'.format(baseline['Label']) if baseline.get('Label') else '',
+        candidate['Id'], ' [{}]'.format(candidate['Label']) if candidate.get('Label') else ''))
+    print('\n'.join(lines))
+    print('Regression found' if regressed else 'No significant regression')
+    sys.exit(1 if regressed else 0)
+
+
+class LiveMetrics:
+    '''
+    Counters and latency histograms of every finished daemon phase, for
+    Prometheus: totals since start, plus a rolling window of per-second
+    slots that is pruned to window sec, so memory stays bounded however
+    long the daemon runs.
+    '''
+    BUCKETS = tuple(2.0 ** e for e in range(-20, 4))  # ~1 us to 8 s
+    QUANTILES = (0.5, 0.99, 0.999)
+
+    def __init__(self, window=60):
+        self.window = window
+        self.lock = threading.Lock()
+        self.started = time()
+        self.passes = 0
+        self.totals = {op: {'bytes': 0, 'ops': 0, 'sum': 0.0, 'buckets': [0] * (len(self.BUCKETS) + 1)}
+                       for op in ('write', 'read')}
+        self.slots = deque()  # (second, op, ops, bytes, buckets), oldest first
+
+    def add(self, op, took, block_size):
+        '''
+        Folds the samples of a finished phase into the totals and the
+        window. A LatencyHistogram has no completion times, so its whole
+        phase is put in the second it finished in.
+        '''
+        if not len(took):
+            return
+        seconds = {}  # whole perf_counter second -> bucket counts
+        if isinstance(took, LatencyHistogram):
+            buckets = seconds[int(time())] = [0] * (len(self.BUCKETS) + 1)
+            for bound, n in took.log_histogram():
+                buckets[bisect_left(self.BUCKETS, bound)] += n
+        else:
+            for t, end in zip(took, took.stamps):
+                buckets = seconds.get(int(end))
+                if buckets is None:
+                    buckets = seconds[int(end)] = [0] * (len(self.BUCKETS) + 1)
+                buckets[bisect_left(self.BUCKETS, t)] += 1  # the first bound >= t
+        with self.lock:
+            total = self.totals[op]
+            total['bytes'] += len(took) * block_size
+            total['ops'] += len(took)
+            total['sum'] += took.total()
+            for second in sorted(seconds):
+                buckets = seconds[second]
+                total['buckets'] = [n + m for n, m in zip(total['buckets'], buckets)]
+                self.slots.append((second, op, sum(buckets), sum(buckets) * block_size, buckets))
+            self.prune()
+
+    def prune(self):
+        oldest = int(time()) - self.window
+        while self.slots and self.slots[0][0] < oldest:
+            self.slots.popleft()
+
+    def quantile(self, buckets, q):
+        '''Upper bound in sec of the bucket holding quantile q, the histogram_quantile way.'''
+        total = sum(buckets)
+        if not total:
+            return float('nan')
+        index = bisect_left(list(accumulate(buckets)), q * total)
+        return self.BUCKETS[index] if index < len(self.BUCKETS) else float('inf')
+
+    def render(self, status):
+        '''The metrics in the Prometheus text exposition format.'''
+        lines = []
+
+        def metric(name, kind, text, samples):
+            lines.append('# HELP monkeytest_{} {}'.format(name, text))
+            lines.append('# TYPE monkeytest_{} {}'.format(name, kind))
+            for labels, value in samples:
+                lines.append('monkeytest_{}{} {}'.format(name, labels, value))
+
+        with self.lock:
+            self.prune()
+            window = {op: [slot for slot in self.slots if slot[1] == op] for op in self.totals}
+            span = min(self.window, max(time() - self.started, 1e-9))
+            metric('passes_total', 'counter', 'Benchmark passes finished.', [('', self.passes)])
+            metric('bytes_total', 'counter', 'Bytes moved by finished phases.',
+                   [('{{op="{}"}}'.format(op), total['bytes']) for op, total in self.totals.items()])
+            metric('ops_total', 'counter', 'Operations done by finished phases.',
+                   [('{{op="{}"}}'.format(op), total['ops']) for op, total in self.totals.items()])
+            samples = []
+            for op, total in self.totals.items():
+                for bound, count in zip(self.BUCKETS, accumulate(total['buckets'])):
+                    samples.append(('_bucket{{op="{}",le="{:g}"}}'.format(op, bound), count))
+                samples.append(('_bucket{{op="{}",le="+Inf"}}'.format(op), total['ops']))
+                samples.append(('_sum{{op="{}"}}'.format(op), total['sum']))
+                samples.append(('_count{{op="{}"}}'.format(op), total['ops']))
+            lines.append('# HELP monkeytest_latency_seconds Latency of every operation.')
+            lines.append('# TYPE monkeytest_latency_seconds histogram')
+            lines.extend('monkeytest_latency_seconds{} {}'.format(labels, value) for labels, value in samples)
+            metric('window_bytes_per_second', 'gauge', 'Throughput over the rolling window.',
+                   [('{{op="{}"}}'.format(op), sum(slot[3] for slot in slots) / span) for op, slots in window.items()])
+            metric('window_iops', 'gauge', 'Operations per second over the rolling window.',
+                   [('{{op="{}"}}'.format(op), sum(slot[2] for slot in slots) / span) for op, slots in window.items()])
+            samples = []
+            for op, slots in window.items():
+                buckets = [sum(counts) for counts in zip(*(slot[4] for slot in slots))] or [0]
+                samples.extend(('{{op="{}",quantile="{:g}"}}'.format(op, q), self.quantile(buckets, q))
+                               for q in self.QUANTILES)
+            metric('window_latency_seconds', 'gauge', 'Latency quantiles over the rolling window (bucket upper bounds).',
+                   samples)
+        metric('phase_bytes', 'gauge', 'Bytes moved so far by the phase in progress.',
+               [('{{phase="{}"}}'.format(status['phase']), status['bytes'])])
+        metric('phase_ops', 'gauge', 'Operations done so far by the phase in progress.',
+               [('{{phase="{}"}}'.format(status['phase']), status['ops'])])
+        return '\n'.join(lines) + '\n'
+
+
+def metrics_server(listen, metrics, status):
+    '''Starts serving /metrics on listen (HOST:PORT or unix:PATH) from a daemon thread.'''
+    import socket
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        '''Serves server.metrics.render(server.status) on GET /metrics.'''
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = self.server.metrics.render(self.server.status).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # scrapes every few seconds for weeks would flood the output
+
+    class MetricsServer(socketserver.ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    class UnixMetricsServer(MetricsServer):
+        address_family = getattr(socket, 'AF_UNIX', None)
+
+        def server_bind(self):
+            socketserver.TCPServer.server_bind(self)  # HTTPServer.server_bind expects a host and port
+            self.server_name, self.server_port = 'localhost', 0
+
+    if listen.startswith('unix:'):
+        path = listen[len('unix:'):]
+        if os.path.exists(path):
+            os.remove(path)
+        server = UnixMetricsServer(path, MetricsHandler)
+    else:
+        host, _, port = listen.rpartition(':')
+        server = MetricsServer((host or '127.0.0.1', int(port)), MetricsHandler)
+    server.metrics, server.status = metrics, status
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+DAEMON_SLICE = 5
+
+
+def run_daemon(args):
+    '''
+    Runs the benchmark over and over on the same test file, folding
+    every finished phase into LiveMetrics served on --listen, until
+    interrupted or terminated. Workloads other than write-read run in
+    slices of DAEMON_SLICE sec (or --runtime), so the metrics keep moving.
+    '''
+    if os.path.isfile(args.file[0]):
+        print('{red}ERROR:{end} {} exists, daemon mode will not delete it'.format(
+            args.file[0], end=col.Style.RESET_ALL, red=col.Fore.RED))
+        exit()
+    benchmark = make_benchmark(args, args.file[0])
+    if benchmark.workload != 'write-read' and not benchmark.runtime:
+        benchmark.runtime = DAEMON_SLICE
+    metrics = LiveMetrics(args.window)
+    try:
+        server = metrics_server(args.listen, metrics, benchmark.status)
+    except (OSError, ValueError) as e:
+        print('{red}ERROR:{end} can not listen on {}: {}'.format(args.listen, e, end=col.Style.RESET_ALL, red=col.Fore.RED))
+        exit()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print('Serving metrics on {}/metrics, stop with Ctrl+C'.format(args.listen))
+    try:
+        while True:
+            benchmark.run_once(show_progress=False)
+            metrics.add('write', benchmark.write_results, 1024 * benchmark.write_block_kb)
+            metrics.add('read', benchmark.read_results, benchmark.read_block)
+            with metrics.lock:
+                metrics.passes += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        if args.listen.startswith('unix:') and os.path.exists(args.listen[len('unix:'):]):
+            os.remove(args.listen[len('unix:'):])
+        if os.path.isfile(benchmark.file):
+            os.remove(benchmark.file)
+
 
 def main():
 
+    if sys.argv[1:2] == ['compare']:
+        compare_main(sys.argv[2:])
+
     args = get_args()
     if args.mode.lower() == 'cli':
-        if os.path.isfile(args.file):
-            if input('Are you sure you wish to continue? Selected file will be deleted. (Y/N) ') == 'Y'.casefold():
-                os.remove(args.file)
+        existing = [file for file in args.file if os.path.isfile(file)]
+        if existing:
+            if input('Are you sure you wish to continue? Selected file{} will be deleted. (Y/N) '.format(
+                    's' if len(existing) > 1 else '')) == 'Y'.casefold():
+                for file in existing:
+                    os.remove(file)
             else:
                 print('Terminated')
                 exit()
@@ -396,17 +3264,16 @@ def main():
                 yellow=col.Fore.YELLOW, end=col.Style.RESET_ALL, red=col.Fore.RED))
             args.read_block_size = 512
 
-        benchmark = Benchmark(args.file, args.size, args.write_block_size, args.read_block_size)
-        benchmark.run()
-        if args.json is not None:
-            benchmark.get_json_result(args.json)
-        else:
-            benchmark.print_result()
-        os.remove(args.file)
+        if len(args.file) > 1:
+            run_targets(args)
+            return
+        benchmark = make_benchmark(args, args.file[0])
+        run_benchmark(args, benchmark)
     elif args.mode.lower() == 'gui':
+        load_gui()
         if 'ttkthemes' in sys.modules:
             root = ttkthemes.ThemedTk()
-            benchmark_gui_var = benchmark_gui(root, args.file, args.size, args.write_block_size, args.read_block_size)
+            benchmark_gui_var = benchmark_gui(root, args.file[0], args.size, args.write_block_size, args.read_block_size)
             if platform.system() == 'Linux':
                 if platform.dist()[0] == 'Ubuntu':
                     root.set_theme("ubuntu")
@@ -419,9 +3286,11 @@ def main():
             root.mainloop()
         else:
             root = tk.Tk()
-            benchmark_gui_var = benchmark_gui(root, args.file, args.size, args.write_block_size, args.read_block_size)
+            benchmark_gui_var = benchmark_gui(root, args.file[0], args.size, args.write_block_size, args.read_block_size)
             root.mainloop()
 
+    elif args.mode.lower() == 'daemon':
+        run_daemon(args)
     elif args.mode.lower() == 'tui':
         try:
             from picotui.context import Context
@@ -441,7 +3310,7 @@ def main():
             dialog = ptwidgets.Dialog(0, 0, 50, 12)
 
             dialog.add(10, 1, "File:")
-            current_file = ptwidgets.WTextEntry(20, args.file)
+            current_file = ptwidgets.WTextEntry(20, args.file[0])
             dialog.add(17, 1, current_file)
 
             dialog.add(10, 3, "Write MB:")
@@ -492,36 +3361,41 @@ def main():
                     yellow=col.Fore.YELLOW, end=col.Style.RESET_ALL, red=col.Fore.RED))
                 args.read_block_size = 512
 
-            benchmark = Benchmark(current_file.get(), args.size, args.write_block_size, args.read_block_size)
-            benchmark.run()
-            if args.json is not None:
-                benchmark.get_json_result(args.json)
-            else:
-                benchmark.print_result()
-            os.remove(args.file)
+            benchmark = make_benchmark(args, current_file.get())
+            run_benchmark(args, benchmark)
 
 
     if args.graph is not None:
+        try:
+            load_plotting()
+        except ImportError:
+            print('{yellow}matplotlib is not installed, not saving the graph{end}'.format(
+                yellow=col.Fore.YELLOW, end=col.Style.RESET_ALL))
+            return
         print(args.graph)
         os.chdir(args.graph_file)
         plt.clf()
         benchmark = benchmark if args.mode.lower() != 'gui' else benchmark_gui_var.benchmark
-        if args.graph == 'Write'.casefold():
+        graph = args.graph.casefold()
+        if graph == 'Write'.casefold():
             benchmark_gui.plot('Write', benchmark, show=False)
             plt.savefig('graph.png')
-        elif args.graph == 'Read':
+        elif graph == 'Read'.casefold():
             benchmark_gui.plot('Read', benchmark, show=False)
             plt.savefig('graph.png')
-        elif args.graph == 'Write+Read'.casefold() or args.graph == 'Read+Write'.casefold():
+        elif graph == 'Write+Read'.casefold() or graph == 'Read+Write'.casefold():
             benchmark_gui.plot('Write', benchmark, show=False)
             benchmark_gui.plot('Read', benchmark, show=False)
             plt.savefig('graph.png')
-        elif args.graph == 'Write/Read'.casefold() or args.graph == 'Read/Write'.casefold():
+        elif graph == 'Write/Read'.casefold() or graph == 'Read/Write'.casefold():
             benchmark_gui.plot('Write', benchmark, show=False)
             plt.savefig('graph1.png')
             plt.clf()
             benchmark_gui.plot('Read', benchmark, show=False)
             plt.savefig('graph2.png')
+        elif graph == 'Throughput'.casefold():
+            benchmark_gui.plot_series(benchmark, show=False)
+            plt.savefig('graph.png')
 
 
 
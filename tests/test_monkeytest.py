@@ -0,0 +1,215 @@
+import ctypes
+import os
+import sys
+from random import Random
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import monkeytest  # noqa: E402
+from monkeytest import (BlockPermutation, LatencyHistogram, SampleStore, mann_whitney, p99_change,  # noqa: E402
+                        parse_sweep)
+
+AWKWARD_COUNTS = (0, 1, 2, 3, 5, 7, 8, 9, 17, 100, 1000, 1023, 1024, 1025)
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def statistics_path(request, monkeypatch):
+    '''Runs a test with numpy (when installed) and with the plain Python fallback.'''
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(monkeytest, 'NUMPY', [None])
+    return request.param
+
+
+@pytest.mark.parametrize('count', AWKWARD_COUNTS)
+def test_permutation_visits_every_block_once(count):
+    order = BlockPermutation(count, seed=count)
+    assert len(order) == count
+    assert sorted(order) == list(range(count))
+
+
+@pytest.mark.parametrize('count', AWKWARD_COUNTS)
+@pytest.mark.parametrize('parts', (1, 2, 3, 4, 7))
+def test_permutation_shares_split_the_blocks(count, parts):
+    order = BlockPermutation(count, seed=parts)
+    shares = [list(order.share(n, parts)) for n in range(parts)]
+    assert sorted(block for share in shares for block in share) == list(range(count))
+    for n, share in enumerate(shares):
+        assert len(share) <= order.capacity(n, parts)
+
+
+def test_permutation_shuffles():
+    order = list(BlockPermutation(1000, seed=1))
+    assert order != sorted(order)
+    assert list(BlockPermutation(1000, seed=1)) == order
+
+
+def test_parse_sweep():
+    assert parse_sweep('4K..64K') == [4096, 8192, 16384, 32768, 65536]
+    assert parse_sweep('512..512') == [512]
+    assert parse_sweep('4K..5K') == [4096]
+    assert parse_sweep('1m..4M') == [1 << 20, 2 << 20, 4 << 20]
+
+
+@pytest.mark.parametrize('text', ('4K', '4K,8K', '64K..4K', '0..4K'))
+def test_parse_sweep_rejects(text):
+    with pytest.raises(ValueError):
+        parse_sweep(text)
+
+
+def stores(values):
+    samples, histogram = SampleStore(len(values)), LatencyHistogram()
+    for i, t in enumerate(values):
+        samples.values[i] = histogram.values[i] = t
+    samples.count = histogram.count = len(values)
+    return samples, histogram
+
+
+def test_histogram_percentiles_match_samples(statistics_path):
+    rng = Random(0)
+    values = [rng.lognormvariate(-9, 1) for _ in range(20000)]
+    samples, histogram = stores(values)
+    ps = monkeytest.Benchmark.PERCENTILES
+    for exact, approx in zip(samples.percentiles(ps[:-1]), histogram.percentiles(ps[:-1])):
+        assert approx == pytest.approx(exact, rel=2 / LatencyHistogram.SUB_BUCKETS)
+    assert histogram.mean() == pytest.approx(samples.mean())
+    assert histogram.stddev() == pytest.approx(samples.stddev(), rel=1e-6)
+    assert (histogram.min(), histogram.max()) == (samples.min(), samples.max())
+
+
+def test_histogram_log_buckets_match_samples(statistics_path):
+    rng = Random(1)
+    values = [rng.uniform(1e-6, 1e-2) for _ in range(5000)] + [2.0 ** -12, 0.0]
+    samples, histogram = stores(values)
+    assert samples.log_histogram() == histogram.log_histogram()
+
+
+def test_mann_whitney_known_values():
+    # U = 0 against a mean of 4.5 and a sigma of sqrt(9 / 12 * 7)
+    assert mann_whitney([1, 2, 3], [4, 5, 6]) == pytest.approx(0.0495346, rel=1e-5)
+    # ties at 2, 4 and 7 share their mean rank: U = 5, sigma = sqrt(30 / 12 * (12 - 36 / 110))
+    assert mann_whitney([1, 2, 2, 3, 5], [2, 4, 4, 6, 7, 7]) == pytest.approx(0.0641466, rel=1e-5)
+
+
+def test_mann_whitney_edge_cases():
+    rng = Random(2)
+    a = [rng.gauss(100, 5) for _ in range(50)]
+    b = [rng.gauss(80, 5) for _ in range(60)]
+    assert mann_whitney(a, a) == pytest.approx(1.0)
+    assert mann_whitney(a, b) == pytest.approx(mann_whitney(b, a))
+    assert mann_whitney(a, b) < 1e-10
+    assert mann_whitney([3, 3, 3], [3, 3]) == 1.0  # all tied
+
+
+def test_p99_change():
+    rng = Random(3)
+    a = [rng.expovariate(1000) for _ in range(2000)]
+    assert p99_change([1.0] * 50, [3.0] * 50, 0.05) == (2.0, 2.0)
+    low, high = p99_change(a, a, 0.05)
+    assert low <= 0 <= high
+    low, high = p99_change(a, [t + 0.01 for t in a], 0.05)
+    assert 0 < low <= 0.01 <= high
+    assert p99_change(a, a[::-1], 0.05) == p99_change(a, a[::-1], 0.05)  # seeded, so repeatable
+
+
+def test_write_read_run(tmp_path):
+    benchmark = monkeytest.Benchmark(str(tmp_path / 'monkeytest'), 4, 256, 4096, sync='none')
+    benchmark.run(show_progress=False)
+    assert benchmark.write_bytes == 4 * 1024 * 1024
+    assert len(benchmark.read_results) == 1024
+    result = benchmark.json_result()
+    assert result['Read block size (B)'] == 4096
+    assert 'Read 1024 x 4096 B blocks' in benchmark.return_result()
+
+
+def test_sweep_reports_the_block_size_it_read(tmp_path):
+    benchmark = monkeytest.Benchmark(str(tmp_path / 'monkeytest'), 4, 256, 512, jobs=2, sync='none')
+    benchmark.sweep_test([4096, 65536], jobs_list=(1, 2), show_progress=False)
+    assert benchmark.read_block == 65536
+    assert benchmark.read_bytes == len(benchmark.read_results) * 65536 == 4 * 1024 * 1024
+    assert 'Read 64 x 65536 B blocks' in benchmark.return_result()
+    result = benchmark.json_result()
+    assert result['Read block size (B)'] == 65536
+    assert result['Read speed in MB/s'] == benchmark.sweep_results[-1]['Read speed in MB/s']
+    assert result['Per-job read speed in MB/s'] == [
+        round(monkeytest.mb_per_sec(len(took) * 65536, took.total()), 2) for took in benchmark.read_worker_took]
+
+
+@pytest.mark.parametrize('block_size, pool_mb', [(1 << 20, 0), (3 << 20, 8), (4096, 0), (8 << 20, 16)])
+def test_payload_slices_stay_aligned(block_size, pool_mb):
+    pool = monkeytest.PayloadPool(block_size, 'zeros', pool_mb=pool_mb, align=4096)
+    base = ctypes.addressof(ctypes.c_char.from_buffer(pool.buffer))
+    blocks = pool.cursor(block_size)
+    limit = len(pool.buffer) - block_size
+    passes = 2 * (limit // 4096 + 1)  # enough for the start shift to wrap around twice
+    for _ in range(passes * (len(pool.buffer) // block_size + 1)):
+        block = next(blocks)
+        assert len(block) == block_size
+        assert (ctypes.addressof(ctypes.c_char.from_buffer(block)) - base) % 4096 == 0
+
+
+class FixedSeries:
+    '''Stands in for a store whose time series is given.'''
+
+    def __init__(self, speeds):
+        self.speeds = speeds
+
+    def time_series(self, block_size, interval):
+        return self.speeds + [0], self.speeds + [0]
+
+
+@pytest.mark.parametrize('speeds, cliffs', [
+    ([100] * 10 + [0] * 12 + [100] * 10, [(1.0, 100, 0)]),
+    ([0] * 12 + [100] * 20, []),
+    ([100] * 20 + [40] * 20, [(2.0, 100, 40)]),
+    ([100] * 40, []),
+])
+def test_series_cliffs(speeds, cliffs):
+    benchmark = monkeytest.Benchmark(os.devnull, 1, 1, 512)
+    stats = benchmark.series_stats(FixedSeries(speeds), 4096)
+    assert [(c['At (sec)'], c['Before MB/s'], c['After MB/s']) for c in stats['Cliffs']] == cliffs
+
+
+def test_unknown_engine_is_rejected():
+    with pytest.raises(ValueError):
+        monkeytest.Benchmark(os.devnull, 1, 1, 512, engine='bogus')
+
+
+def test_async_flush_time_fits_in_the_phase(tmp_path):
+    benchmark = monkeytest.Benchmark(str(tmp_path / 'monkeytest'), 4, 64, 4096, jobs=4, engine='async')
+    benchmark.run(show_progress=False)
+    assert len(benchmark.write_results) == 64
+    assert 0 < benchmark.write_flush_time <= benchmark.write_time
+
+
+def test_find_record():
+    records = [{'Id': '20260101-000000-aaaa', 'Label': 'base', 'Config': {'file': 'a'}},
+               {'Id': '20260102-000000-bbbb', 'Label': 'multi', 'Config': {'file': 'a'}},
+               {'Id': '20260102-000000-cccc', 'Label': 'multi', 'Config': {'file': 'b'}}]
+    assert monkeytest.find_record(records, 'base') is records[0]
+    assert monkeytest.find_record(records, '20260102-000000-c') is records[2]
+    assert monkeytest.find_record(records, '-1') is records[2]
+    with pytest.raises(ValueError, match='matches 2 runs'):
+        monkeytest.find_record(records, 'multi')
+    with pytest.raises(ValueError):
+        monkeytest.find_record(records, 'missing')
+
+
+def test_ready_hook_runs_before_preallocation(tmp_path, monkeypatch):
+    benchmark = monkeytest.Benchmark(str(tmp_path / 'monkeytest'), 4, 256, 4096, sync='none', preallocate='sparse')
+    calls = []
+    benchmark.ready = lambda: calls.append('ready')
+    monkeypatch.setattr(monkeytest, 'usage_snapshot', lambda device: calls.append('timed'))
+    monkeypatch.setattr(monkeytest, 'usage_delta', lambda before, after, device: {})
+    benchmark.run(show_progress=False)
+    assert calls[:2] == ['ready', 'timed']
+    assert calls.count('ready') == 1
+
+
+def test_compress_percent_is_checked_up_front():
+    with pytest.raises(ValueError, match='--compress-percent'):
+        monkeytest.Benchmark(os.devnull, 1, 1, 512, payload='compressible', compress_percent=150)
+    monkeytest.Benchmark(os.devnull, 1, 1, 512, payload='random', compress_percent=150)